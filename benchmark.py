@@ -0,0 +1,243 @@
+"""
+Benchmarks for loading, respawning, updating and drawing every level.
+
+Writes p50/p95/p99 timings, in milliseconds, and peak memory to a JSON file
+so runs from different commits can be compared:
+
+    python benchmark.py --output before.json
+"""
+import argparse
+import contextlib
+import glob
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import time
+
+import pyglet
+
+# The game logic runs headless, the draw benchmark makes its own hidden window
+pyglet.options["shadow_window"] = False
+
+import arcade
+import main
+
+
+def percentiles(samples: list) -> dict:
+    """ p50/p95/p99 of timings in seconds, in milliseconds """
+    if not samples:
+        return {"count": 0}
+    samples = sorted(samples)
+
+    def rank(fraction):
+        return round(samples[min(len(samples) - 1, int(fraction * len(samples)))] * 1000, 4)
+
+    return {"count": len(samples),
+            "p50": rank(0.50),
+            "p95": rank(0.95),
+            "p99": rank(0.99),
+            "mean": round(sum(samples) / len(samples) * 1000, 4)}
+
+
+def peak_rss_mb() -> float:
+    """ Most memory the process has used so far """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    if sys.platform == "darwin":
+        peak /= 1024
+    return round(peak / 1024, 1)
+
+
+def timed(samples: list, function):
+    """ Wrap a function so each call's time is added to the last entry of samples """
+    def wrapper(*args, **kwargs):
+        start_time = time.perf_counter()
+        result = function(*args, **kwargs)
+        samples[-1] += time.perf_counter() - start_time
+        return result
+    return wrapper
+
+
+@contextlib.contextmanager
+def cold_hit_boxes():
+    """
+    Trace hit boxes the way arcade does on its own, past main's hit box
+    cache, and forget arcade's loaded textures, which keep their hit boxes
+    """
+    cached = (arcade.texture.calculate_hit_box_points_simple,
+              arcade.texture.calculate_hit_box_points_detailed)
+    arcade.texture.calculate_hit_box_points_simple = arcade.calculate_hit_box_points_simple
+    arcade.texture.calculate_hit_box_points_detailed = arcade.calculate_hit_box_points_detailed
+    arcade.load_texture.texture_cache.clear()
+    try:
+        yield
+    finally:
+        (arcade.texture.calculate_hit_box_points_simple,
+         arcade.texture.calculate_hit_box_points_detailed) = cached
+        arcade.load_texture.texture_cache.clear()
+
+
+def benchmark_parse(map_name: str, repeat: int) -> dict:
+    """
+    read_tmx, and process_layer for each layer the game reads. Layers are
+    timed "cold", tracing every hit box, once and then "cached" repeat times.
+    """
+    read_times = []
+    layer_times = {}
+    layer_sizes = {}
+    for run in range(repeat + 1):
+        mode = "cold" if run == 0 else "cached"
+        with cold_hit_boxes() if mode == "cold" else contextlib.nullcontext():
+            start_time = time.perf_counter()
+            my_map = arcade.tilemap.read_tmx(map_name)
+            read_times.append(time.perf_counter() - start_time)
+            for _attribute, layer_name, options in main.level_layers(main.find_key_lock_numbers(my_map)):
+                start_time = time.perf_counter()
+                sprite_list = arcade.tilemap.process_layer(my_map, layer_name, **options)
+                times = layer_times.setdefault(layer_name, {"cold": [], "cached": []})
+                times[mode].append(time.perf_counter() - start_time)
+                layer_sizes[layer_name] = {"tiles": len(sprite_list),
+                                           "hit_box_algorithm": options.get("hit_box_algorithm", "Simple")}
+    return {"read_tmx": percentiles(read_times),
+            "layers": {layer_name: dict(layer_sizes[layer_name],
+                                        cold=percentiles(times["cold"]),
+                                        cached=percentiles(times["cached"]))
+                       for layer_name, times in layer_times.items()}}
+
+
+def benchmark_update(game_view: main.GameWindow, frames: int) -> dict:
+    """ on_update at 60 fps, holding right and jumping now and then, split into its parts """
+    frame_times = []
+    split_times = {"physics_step": [], "moving_sprites": [], "collisions": []}
+    game_view.physics_engine.step = timed(split_times["physics_step"], game_view.physics_engine.step)
+    game_view.move_moving_sprites = timed(split_times["moving_sprites"], game_view.move_moving_sprites)
+    game_view.check_collisions = timed(split_times["collisions"], game_view.check_collisions)
+
+    for frame in range(frames):
+        for samples in split_times.values():
+            samples.append(0.0)
+        game_view.apply_input(main.INPUT_RIGHT | (main.INPUT_UP if frame % 90 < 10 else 0))
+        start_time = time.perf_counter()
+        game_view.on_update(1 / 60)
+        frame_times.append(time.perf_counter() - start_time)
+
+    del game_view.physics_engine.step, game_view.move_moving_sprites, game_view.check_collisions
+    result = {"frame": percentiles(frame_times)}
+    for name, samples in split_times.items():
+        result[name] = percentiles(samples)
+    return result
+
+
+def benchmark_draw(game_view: main.GameWindow, window: arcade.Window, frames: int) -> dict:
+    """ on_draw while walking through the level, waiting for the GPU to finish each frame """
+    draw_times = []
+    for frame in range(frames):
+        game_view.apply_input(main.INPUT_RIGHT | (main.INPUT_UP if frame % 90 < 10 else 0))
+        game_view.on_update(1 / 60)
+        arcade.set_viewport(game_view.view_left, main.SCREEN_WIDTH + game_view.view_left,
+                            game_view.view_bottom, main.SCREEN_HEIGHT + game_view.view_bottom)
+        start_time = time.perf_counter()
+        game_view.on_draw()
+        window.ctx.finish()
+        draw_times.append(time.perf_counter() - start_time)
+    return dict(percentiles(draw_times), draw_calls=game_view.draw_calls)
+
+
+def benchmark_level(level: int, window: arcade.Window, args) -> dict:
+    """ Every benchmark for one level """
+    map_name = f"{main.PROJECT_PATH}/level_{level}.tmx"
+    result = {"parse": benchmark_parse(map_name, args.repeat)}
+
+    # The first setup also compiles the level, the rest reuse it
+    setup_times = []
+    for _ in range(args.repeat + 1):
+        start_time = time.perf_counter()
+        game_view = main.GameWindow(headless=True)
+        game_view.level = level
+        game_view.setup(level)
+        setup_times.append(time.perf_counter() - start_time)
+    result["compile_and_setup"] = percentiles(setup_times[:1])
+    result["setup"] = percentiles(setup_times[1:])
+
+    compiled_level = main.load_level(level)
+    result["map"] = {"width": compiled_level.map_width,
+                     "height": compiled_level.map_height,
+                     "physics_shapes": len(game_view.physics_engine.space.shapes),
+                     "wall_rectangles": len(compiled_level.wall_rectangles)}
+
+    respawn_times = []
+    for _ in range(args.respawns):
+        start_time = time.perf_counter()
+        game_view.restore()
+        respawn_times.append(time.perf_counter() - start_time)
+    result["respawn"] = percentiles(respawn_times)
+
+    game_view.restore()
+    result["update"] = benchmark_update(game_view, args.frames)
+
+    if window is None:
+        result["draw"] = {"skipped": "no window"}
+    else:
+        game_view.restore()
+        result["draw"] = benchmark_draw(game_view, window, args.frames)
+
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+def git_commit() -> str:
+    """ The commit being benchmarked, if we're in a git checkout """
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+
+def main_benchmark():
+    """ Benchmark every level and write the results """
+    parser = argparse.ArgumentParser(description="Benchmark every level")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file to write the results to")
+    parser.add_argument("--repeat", type=int, default=5, help="times to parse and set up each level")
+    parser.add_argument("--respawns", type=int, default=100, help="respawns to time per level")
+    parser.add_argument("--frames", type=int, default=600, help="frames to update and draw per level")
+    parser.add_argument("--no-draw", action="store_true", help="skip the draw benchmark")
+    args = parser.parse_args()
+
+    # A hidden window gives the draw benchmark an offscreen context
+    window = None
+    if not args.no_draw:
+        try:
+            window = arcade.Window(main.SCREEN_WIDTH, main.SCREEN_HEIGHT, main.SCREEN_TITLE, visible=False)
+        except Exception as error:
+            print(f"Not benchmarking drawing, no window: {error}")
+
+    results = {"commit": git_commit(),
+               "python": sys.version.split()[0],
+               "arcade": arcade.version.VERSION,
+               "levels": {}}
+
+    read_times = []
+    for _ in range(args.repeat):
+        start_time = time.perf_counter()
+        arcade.tilemap.read_tmx(f"{main.PROJECT_PATH}/bg.tmx")
+        read_times.append(time.perf_counter() - start_time)
+    results["title"] = {"read_tmx": percentiles(read_times)}
+
+    levels = sorted(int(re.search(r"level_(\d+)\.tmx$", map_name).group(1))
+                    for map_name in glob.glob(f"{main.PROJECT_PATH}/level_*.tmx"))
+    for level in levels:
+        print(f"Level {level}")
+        results["levels"][f"level_{level}"] = benchmark_level(level, window, args)
+
+    results["peak_rss_mb"] = peak_rss_mb()
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main_benchmark()
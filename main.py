@@ -1,10 +1,33 @@
 """
   2Example of Pymunk Physics Engine Platformer
   3"""
+import bisect
+import collections
+import concurrent.futures
+import functools
+import gc
+import hashlib
+import itertools
+import json
 import math
+import argparse
+import re
+import struct
+import sys
+import threading
+import time
 from typing import Optional
+import pyglet
+
+# Running headless there may be no display to open pyglet's shadow window on
+if any(arg.startswith(("--headless", "--replay")) for arg in sys.argv):
+    pyglet.options["shadow_window"] = False
+
 import arcade
+import numpy
 import os
+import PIL.Image
+import pymunk
 
 SCREEN_TITLE = "The Legend of Rakesh"
 
@@ -39,6 +62,7 @@ PLAYER_DAMPING = 0.4
 PLAYER_FRICTION = 1.0
 WALL_FRICTION = 0.7
 DYNAMIC_ITEM_FRICTION = 0.6
+HAZARD_FRICTION = 0.2
 
 # Mass (defaults to 1)
 PLAYER_MASS = 2.0
@@ -66,6 +90,25 @@ LEFT_FACING = 1
 # How many pixels to move before we change the texture in the walking animation
 DISTANCE_TO_CHANGE_TEXTURE = 20
 
+# Characters from Kenney.nl's Character pack that can be used as the player's skin
+CHARACTER_SKINS = ("female_adventurer", "female_person", "male_person",
+                   "male_adventurer", "zombie", "robot")
+PLAYER_SKIN = "male_person"
+
+# Animation states of a character, and the images each one cycles through
+STATE_IDLE = 0
+STATE_JUMP = 1
+STATE_FALL = 2
+STATE_WALK = 3
+STATE_CLIMB = 4
+ANIMATION_FRAMES = (("idle",),
+                    ("jump",),
+                    ("fall",),
+                    tuple(f"walk{i}" for i in range(8)),
+                    ("climb0", "climb1"))
+# Climbing faces the ladder, so those frames aren't mirrored when facing left
+MIRRORED_STATES = (STATE_IDLE, STATE_JUMP, STATE_FALL, STATE_WALK)
+
 # How much force to put on the bullet
 BULLET_MOVE_FORCE = 9000
 
@@ -75,17 +118,568 @@ BULLET_MASS = 0.1
 # Make bullet less affected by gravity
 BULLET_GRAVITY = 300
 
+# Most bullets in flight at once, how many seconds each lasts, and how far off the map they can go
+BULLET_POOL_SIZE = 20
+BULLET_LIFETIME = 3.0
+BULLET_CULL_MARGIN = 100
+
 LEFT_VIEWPORT_MARGIN = 200
 RIGHT_VIEWPORT_MARGIN = 200
 BOTTOM_VIEWPORT_MARGIN = 150
 TOP_VIEWPORT_MARGIN = 100
 
+# Solid layers whose tiles get merged into large collision rectangles
+MERGED_WALL_LAYERS = ("Platforms", "Barrier")
+
+# A tile counts as a rectangle if its hit box fills this much of its bounding box
+RECTANGLE_FILL = 0.95
+
+# Kinds of entity kept in the EntityStore, one bit each so they can be
+# asked for together
+ENTITY_COIN = 1
+ENTITY_STAR = 2
+ENTITY_SPIKE = 4
+ENTITY_BOMB = 8
+ENTITY_LAVA = 16
+ENTITY_PRIZE = 32
+ENTITY_EXIT = 64
+ENTITY_ANY = ENTITY_COIN | ENTITY_STAR | ENTITY_SPIKE | ENTITY_BOMB | ENTITY_LAVA | ENTITY_PRIZE | ENTITY_EXIT
+
+# Layers whose tiles are entities rather than sprites, and their kinds
+ENTITY_LAYERS = {"Coins": ENTITY_COIN,
+                 "Stars": ENTITY_STAR,
+                 "Spikes": ENTITY_SPIKE,
+                 "Bombs": ENTITY_BOMB,
+                 "Lava": ENTITY_LAVA,
+                 "Prize": ENTITY_PRIZE,
+                 "Exit Sign": ENTITY_EXIT}
+
+# Size of the chunks static layers are split into for drawing, in pixels
+CHUNK_SIZE = 16 * SPRITE_SIZE
+
+# The level background images are cut into square tiles of this many pixels,
+# with each mip level half the size of the one before it
+BACKGROUND_TILE_PIXELS = 512
+BACKGROUND_MIP_LEVELS = 3
+
+# Memory allowed for background tiles kept in memory, in bytes
+BACKGROUND_TEXTURE_BUDGET = 64 * 1024 * 1024
+
+# How many tiles past the edge of the screen to load in the direction we move
+BACKGROUND_PREFETCH_TILES = 1
+
+# How many frames of draw timing to average over
+FRAME_TIME_SAMPLES = 120
+
+# Physics and game logic run in steps of this many seconds, whatever the frame rate
+PHYSICS_STEP = 1 / 120
+
+# Most steps run in one frame. If a stall leaves us further behind, the game slows down instead.
+MAX_PHYSICS_STEPS = 5
+
+# Moving sprites' change_x and change_y from the map are in pixels per frame at this rate
+MOVING_SPRITE_FRAME_RATE = 60
+
+# Items and moving sprites further than this many pixels off screen are put to sleep or
+# frozen. Who's in range is checked this often, in seconds, or when the view moves half the margin.
+ACTIVATION_MARGIN = 600
+ACTIVATION_INTERVAL = 0.25
+
+# Nothing falls asleep by itself, but Pymunk only lets bodies be put to sleep when this isn't infinite
+SLEEP_TIME_THRESHOLD = 1e9
+
+# The next level starts building in the background once every star is
+# collected or the player is this many pixels from an exit
+PREFETCH_DISTANCE = 1000
+
+# A finished level is taken apart this many sprites or physics objects at
+# a time, for at most this many seconds a frame
+RELEASE_CHUNK = 200
+RELEASE_BUDGET = 0.002
+
+# How many timed scopes the profiler remembers, and how far back a trace dump goes, in seconds
+PROFILE_EVENTS = 50000
+PROFILE_TRACE_SECONDS = 10
+
+# How often the performance overlay's text is refreshed, in seconds, and the frame time its graph tops out at
+OVERLAY_REFRESH = 0.5
+OVERLAY_GRAPH_MAX = 1 / 20
+
+# Time step of a headless run, in seconds
+HEADLESS_DELTA_TIME = 1 / 60
+
+# Bits of a frame's input, and the key each one stands for
+INPUT_LEFT = 1
+INPUT_RIGHT = 2
+INPUT_UP = 4
+INPUT_DOWN = 8
+INPUT_KEYS = ((INPUT_LEFT, arcade.key.LEFT),
+              (INPUT_RIGHT, arcade.key.RIGHT),
+              (INPUT_UP, arcade.key.UP),
+              (INPUT_DOWN, arcade.key.DOWN))
+
+# Input log: a header, then records of (frame index, kind) followed by the kind's data
+INPUT_LOG_MAGIC = b"RKIN"
+INPUT_LOG_VERSION = 1
+INPUT_LOG_HEADER = struct.Struct("<4sBB")
+INPUT_LOG_RECORD = struct.Struct("<IB")
+RECORD_FRAME = 0
+RECORD_KEY_PRESS = 1
+RECORD_KEY_RELEASE = 2
+RECORD_MOUSE_PRESS = 3
+INPUT_LOG_DATA = {RECORD_FRAME: struct.Struct("<d"),
+                  RECORD_KEY_PRESS: struct.Struct("<II"),
+                  RECORD_KEY_RELEASE: struct.Struct("<II"),
+                  RECORD_MOUSE_PRESS: struct.Struct("<iiII")}
+
+# Where the levels and other game files live
+PROJECT_PATH = "/Users/mahirkhandokar/Desktop/Projects/the_legend_of_rakesh"
+
+# Map layers read for every level.
+# Each entry is (GameWindow attribute, layer name, process_layer options).
+# Entity layers have no attribute, their tiles go in the EntityStore.
+LEVEL_LAYERS = (
+    ("wall_list", "Platforms", {"scaling": SPRITE_SCALING_TILES,
+                                "hit_box_algorithm": "Detailed"}),
+    ("p_wall_list", "Phasable walls", {"scaling": SPRITE_SCALING_TILES,
+                                       "hit_box_algorithm": "Detailed"}),
+    ("misc", "Other Stuff", {"scaling": SPRITE_SCALING_TILES,
+                             "hit_box_algorithm": "Detailed"}),
+    ("item_list", "Dynamic Items", {"scaling": SPRITE_SCALING_TILES,
+                                    "hit_box_algorithm": "Detailed"}),
+    ("ladder_list", "Ladders", {"scaling": SPRITE_SCALING_TILES,
+                                "use_spatial_hash": True,
+                                "hit_box_algorithm": "Detailed"}),
+    (None, "Coins", {"scaling": SPRITE_SCALING_TILES,
+                     "hit_box_algorithm": "Detailed"}),
+    (None, "Spikes", {"scaling": SPRITE_SCALING_TILES,
+                      "hit_box_algorithm": "Simple"}),
+    (None, "Bombs", {"scaling": SPRITE_SCALING_TILES,
+                     "hit_box_algorithm": "Detailed"}),
+    (None, "Stars", {"scaling": SPRITE_SCALING_TILES,
+                     "hit_box_algorithm": "Detailed"}),
+    (None, "Exit Sign", {"scaling": SPRITE_SCALING_TILES,
+                         "hit_box_algorithm": "Detailed"}),
+    ("barrier", "Barrier", {"scaling": SPRITE_SCALING_TILES,
+                            "use_spatial_hash": True,
+                            "hit_box_algorithm": "Detailed"}),
+    (None, "Prize", {"scaling": SPRITE_SCALING_TILES,
+                     "hit_box_algorithm": "Detailed"}),
+    (None, "Lava", {"scaling": SPRITE_SCALING_TILES,
+                    "hit_box_algorithm": "Detailed"}),
+    ("moving_sprites_list", "Moving Platforms", {"scaling": SPRITE_SCALING_TILES}),
+    ("moving_spikes_list", "Moving Spikes", {"scaling": SPRITE_SCALING_TILES,
+                                             "hit_box_algorithm": "Simple"}),
+)
+
+# Every "Key N" layer is opened by the matching "Lock N" layer, for any N
+KEY_LOCK_LAYER = re.compile(r"^(Key|Lock) (\d+)$")
+# Keys follow the player once picked up, and moving a sprite in a spatial hash costs more than
+# looking through the few keys of a layer
+KEY_LAYER_OPTIONS = {"scaling": SPRITE_SCALING_TILES,
+                     "use_spatial_hash": False,
+                     "hit_box_algorithm": "Detailed"}
+LOCK_LAYER_OPTIONS = {"scaling": SPRITE_SCALING_TILES,
+                      "use_spatial_hash": True,
+                      "hit_box_algorithm": "None"}
+
+# Layers of the title screen's map, in drawing order. The background layers
+# use the levels' huge images, so they are streamed the same way.
+TITLE_BACKGROUND_LAYERS = ("Grass", "Sand", "Snow", "Haunted", "City")
+TITLE_LAYERS = ("Platforms", "Ladders", "Misc.")
+
+# Arcade's resources inside the project's virtualenv, where the sounds come from
+ARCADE_RESOURCES = f"{PROJECT_PATH}/venv/lib/python3.8/site-packages/arcade/resources"
+
+# Sound effects share a fixed number of voices. The same sound can't start
+# again within SOUND_MIN_INTERVAL seconds or play on more than
+# SOUND_MAX_VOICES voices at once.
+MIXER_VOICES = 8
+SOUND_MIN_INTERVAL = 0.05
+SOUND_MAX_VOICES = 2
+
+# Hit boxes traced from texture images, saved next to the maps
+HIT_BOX_CACHE = f"{PROJECT_PATH}/hit_boxes.json"
+HIT_BOX_CACHE_VERSION = 1
+
+
+class AssetRegistry:
+    """
+    Sounds, character skins, compiled levels and background tiles, loaded
+    once per process and shared by every game view.
+
+    Everything asked for since the last release_unused() call is marked as used,
+    anything else is dropped by it so a level change doesn't keep the old level's assets.
+    """
+
+    def __init__(self):
+        self.assets = {}
+        self.used = set()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def _get(self, key, load):
+        with self.lock:
+            self.used.add(key)
+            asset = self.assets.get(key)
+            if asset is not None:
+                self.hits += 1
+                return asset
+            self.misses += 1
+        # Load outside the lock, a second thread loading the same asset just wastes the work
+        asset = load()
+        with self.lock:
+            return self.assets.setdefault(key, asset)
+
+    def sound(self, file_name: str) -> arcade.Sound:
+        """ Get a sound, decoding it on first use """
+        return self._get(("sound", file_name), lambda: arcade.load_sound(file_name))
+
+    def skin(self, name: str) -> "CharacterSkin":
+        """ Get every animation frame of a character from Kenney.nl's Character pack """
+        # female_adventurer's images are female_adventurer/femaleAdventurer_*.png
+        first_word, *other_words = name.split("_")
+        file_prefix = first_word + "".join(word.capitalize() for word in other_words)
+        main_path = f":resources:images/animated_characters/{name}/{file_prefix}"
+        return self._get(("skin", main_path), lambda: CharacterSkin(main_path))
+
+    def level(self, map_name: str) -> "CompiledLevel":
+        """ Get a compiled level, compiling it again if its TMX file changed """
+        key = ("level", map_name)
+        compiled_level = self._get(key, lambda: CompiledLevel(map_name))
+        if compiled_level.mtime != os.path.getmtime(map_name):
+            with self.lock:
+                if self.assets.get(key) is compiled_level:
+                    del self.assets[key]
+            compiled_level = self._get(key, lambda: CompiledLevel(map_name))
+        return compiled_level
+
+    def background(self, image_path: str, left: float, bottom: float, budget: int) -> "TextureCache":
+        """ Get the loaded tiles of a background image placed somewhere in a map """
+        return self._get(("background", (image_path, left, bottom)), lambda: TextureCache(budget))
+
+    def release_unused(self):
+        """ Drop everything that wasn't asked for since the last call """
+        with self.lock:
+            released = {key: self.assets.pop(key) for key in self.assets.keys() - self.used}
+            self.used.clear()
+
+            # Arcade keeps its own cache of loaded textures. Forget the ones
+            # only the released assets used.
+            kept = set()
+            for (kind, _name), asset in self.assets.items():
+                if kind == "level":
+                    kept |= asset.texture_names
+            kept_files = {texture_name.rsplit("-", 8)[0] for texture_name in kept}
+            texture_cache = arcade.load_texture.texture_cache
+            for (kind, name), asset in released.items():
+                if kind == "skin":
+                    # Keyed by the file name first
+                    for cache_name in [cache_name for cache_name in texture_cache if cache_name.startswith(name)]:
+                        del texture_cache[cache_name]
+                elif kind == "level":
+                    for texture_name in asset.texture_names - kept:
+                        texture_cache.pop(texture_name, None)
+                        # The whole image the tile was cut from is cached by its file name
+                        file_name = texture_name.rsplit("-", 8)[0]
+                        if file_name not in kept_files:
+                            texture_cache.pop(file_name, None)
+
+    def stats(self) -> dict:
+        """ Loaded asset count and cache hits/misses """
+        with self.lock:
+            return {"loaded": len(self.assets), "hits": self.hits, "misses": self.misses}
+
+
+# Assets shared by every game view
+assets = AssetRegistry()
+
+
+class HitBoxCache:
+    """
+    Hit boxes traced from texture images, kept on disk so an image is only
+    traced once, not once per layer, level and run. Entries are keyed by a
+    hash of the image's pixels and the hit box algorithm.
+
+    install() makes arcade's textures look their hit boxes up here.
+    """
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        # Read from disk the first time a hit box is asked for
+        self.hit_boxes = None
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # Held while writing the file, both loader threads save
+        self.save_lock = threading.Lock()
+
+    def _load(self):
+        """ Read the cache file, ignoring it if it was traced by another arcade """
+        self.hit_boxes = {}
+        try:
+            with open(self.file_name) as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return
+        if data.get("version") == HIT_BOX_CACHE_VERSION and data.get("arcade") == arcade.version.VERSION:
+            self.hit_boxes = {key: tuple(tuple(point) for point in points)
+                              for key, points in data["hit_boxes"].items()}
+
+    def points(self, image: PIL.Image.Image, algorithm: str, trace):
+        """ The hit box of an image, calling trace() only if it isn't cached """
+        digest = hashlib.sha1(image.tobytes()).hexdigest()
+        key = f"{algorithm}-{image.mode}-{image.width}x{image.height}-{digest}"
+        with self.lock:
+            if self.hit_boxes is None:
+                self._load()
+            points = self.hit_boxes.get(key)
+            if points is not None:
+                self.hits += 1
+                return points
+
+        points = tuple(tuple(point) for point in trace())
+        with self.lock:
+            self.hit_boxes[key] = points
+            self.dirty = True
+            self.misses += 1
+        return points
+
+    def save(self):
+        """ Write the cache out, if anything new was traced """
+        with self.save_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                # A copy, the other loader thread may trace more while this one writes
+                data = {"version": HIT_BOX_CACHE_VERSION,
+                        "arcade": arcade.version.VERSION,
+                        "hit_boxes": dict(self.hit_boxes)}
+                self.dirty = False
+            # Write a new file and swap it in, so a crash never leaves half a cache
+            temp_name = f"{self.file_name}.tmp"
+            try:
+                with open(temp_name, "w") as file:
+                    json.dump(data, file, separators=(",", ":"))
+                os.replace(temp_name, self.file_name)
+            except OSError as error:
+                print(f"Couldn't save hit box cache: {error}")
+
+    def install(self):
+        """ Route arcade's hit box tracing through the cache """
+        trace_simple = arcade.texture.calculate_hit_box_points_simple
+        trace_detailed = arcade.texture.calculate_hit_box_points_detailed
+
+        def simple(image):
+            return self.points(image, "Simple", lambda: trace_simple(image))
+
+        def detailed(image, hit_box_detail=4.5):
+            return self.points(image, f"Detailed-{hit_box_detail}",
+                               lambda: trace_detailed(image, hit_box_detail))
+
+        arcade.texture.calculate_hit_box_points_simple = simple
+        arcade.texture.calculate_hit_box_points_detailed = detailed
+
+    def stats(self) -> dict:
+        """ Cached hit box count and cache hits/misses """
+        with self.lock:
+            return {"cached": len(self.hit_boxes or ()), "hits": self.hits, "misses": self.misses}
+
+
+# Hit boxes shared by every texture
+hit_boxes = HitBoxCache(HIT_BOX_CACHE)
+hit_boxes.install()
+
+
+def hit_box_bounds(points) -> tuple:
+    """ Left, bottom, right and top of a hit box, the same as a sprite's edges """
+    x_points = [point[0] for point in points]
+    y_points = [point[1] for point in points]
+    return min(x_points), min(y_points), max(x_points), max(y_points)
+
+
+class Voice(pyglet.media.Player):
+    """ A player the audio mixer reuses for one sound after another """
+
+    def on_eos(self):
+        """
+        pyglet sends this when the sound ends. The voice is kept as it is,
+        for the mixer to queue its next sound on.
+        """
+
+
+class AudioMixer:
+    """ Sound effects played on a fixed pool of voices, each sound decoded once """
+
+    def __init__(self, voices: int, min_interval: float, max_voices_per_sound: int):
+        self.voice_count = voices
+        self.min_interval = min_interval
+        self.max_voices_per_sound = max_voices_per_sound
+        # Length of each loaded sound, in seconds
+        self.lengths = {}
+        self.last_started = {}
+        # The voices, and [sound id, start time, end time] of what each one played last
+        self.voices = []
+        self.playing = []
+
+    def load(self, file_name: str) -> str:
+        """ Decode a sound, and get the ID to play it with """
+        self.lengths[file_name] = assets.sound(file_name).get_length()
+        return file_name
+
+    def play(self, sound_id: str):
+        """ Start a sound on an idle voice, or the oldest one, unless it started too recently """
+        now = time.perf_counter()
+        if now - self.last_started.get(sound_id, -math.inf) < self.min_interval:
+            return
+        self.last_started[sound_id] = now
+
+        same_sound = [index for index, entry in enumerate(self.playing) if entry[0] == sound_id and entry[2] > now]
+        if len(same_sound) >= self.max_voices_per_sound:
+            index = min(same_sound, key=lambda index: self.playing[index][1])
+        elif len(self.voices) < self.voice_count:
+            index = len(self.voices)
+            self.voices.append(Voice())
+            self.playing.append(None)
+        else:
+            index = min(range(len(self.playing)),
+                        key=lambda index: (self.playing[index][2] > now, self.playing[index][1]))
+        self.playing[index] = [sound_id, now, now + self.lengths[sound_id]]
+
+        # Sounds are looked up each time so they can be released with the level
+        voice = self.voices[index]
+        voice.pause()
+        if voice.source is not None:
+            voice.next_source()
+        voice.queue(assets.sound(sound_id).source)
+        voice.play()
+
+
+# Sound effects of every game view
+audio = AudioMixer(MIXER_VOICES, SOUND_MIN_INTERVAL, SOUND_MAX_VOICES)
+
+
+class ProfileScope:
+    """ One timed with statement, recorded as an event when it ends """
+    __slots__ = ("events", "name", "start")
+
+    def __init__(self, events: collections.deque, name: str):
+        self.events = events
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.events.append((self.name, self.start, time.perf_counter(), threading.get_ident()))
+
+
+class Profiler:
+    """
+    Timings of named scopes, kept in a ring buffer of (name, start, end, thread)
+    events. Garbage collections are recorded as scopes too.
+    """
+
+    def __init__(self, size: int):
+        self.events = collections.deque(maxlen=size)
+        self.frame_starts = collections.deque(maxlen=FRAME_TIME_SAMPLES)
+        self.gc_start = None
+        gc.callbacks.append(self._gc_callback)
+
+    def scope(self, name: str) -> ProfileScope:
+        """ Time the body of a with statement """
+        return ProfileScope(self.events, name)
+
+    def timed(self, name: str):
+        """ Decorator that times every call of a function as a scope """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.events.append((name, start, time.perf_counter(), threading.get_ident()))
+            return wrapper
+        return decorator
+
+    def _gc_callback(self, phase, info):
+        if phase == "start":
+            self.gc_start = time.perf_counter()
+        elif self.gc_start is not None:
+            self.events.append((f"gc generation {info['generation']}", self.gc_start,
+                                time.perf_counter(), threading.get_ident()))
+            self.gc_start = None
+
+    def mark_frame(self):
+        """ Note that a frame started, for the frame time graph """
+        self.frame_starts.append(time.perf_counter())
+
+    def frame_times(self) -> list:
+        """ Time between the starts of the last few frames, in seconds """
+        starts = list(self.frame_starts)
+        return [end - start for start, end in zip(starts, starts[1:])]
+
+    def recent(self, seconds: float) -> list:
+        """ The events that started in the last few seconds """
+        since = time.perf_counter() - seconds
+        return [event for event in self.events if event[1] >= since]
+
+    def dump_chrome_trace(self, file_name: str, seconds: float = PROFILE_TRACE_SECONDS):
+        """ Write the last few seconds of events as a trace for chrome://tracing or Perfetto """
+        trace_events = [{"name": name, "ph": "X", "pid": os.getpid(), "tid": thread,
+                         "ts": start * 1e6, "dur": (end - start) * 1e6}
+                        for name, start, end, thread in self.recent(seconds)]
+        with open(file_name, "w") as file:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, file)
+
+
+# Timings of every game view
+profiler = Profiler(PROFILE_EVENTS)
+
+
+class CharacterSkin:
+    """
+    Every animation frame of one character, looked up by
+    frames[state][facing][frame]. Preloading textures into a sprite list packs
+    them all into its atlas at once, instead of rebuilding the atlas each
+    time a frame is shown for the first time.
+    """
+
+    def __init__(self, main_path: str):
+        self.frames = []
+        for state, names in enumerate(ANIMATION_FRAMES):
+            right = tuple(arcade.load_texture(f"{main_path}_{name}.png") for name in names)
+            left = right
+            if state in MIRRORED_STATES:
+                left = tuple(arcade.load_texture(f"{main_path}_{name}.png", flipped_horizontally=True)
+                             for name in names)
+            self.frames.append((right, left))
+        self.frames = tuple(self.frames)
+
+        # Every distinct texture, to preload into sprite lists
+        self.textures = list({texture.name: texture
+                              for facings in self.frames
+                              for textures in facings
+                              for texture in textures}.values())
+
+
+def is_grounded(physics_engine: arcade.PymunkPhysicsEngine, sprite: arcade.Sprite) -> bool:
+    """
+    Whether a sprite is standing on something, the same answer as the
+    engine's is_on_ground, from the collision normals alone rather than
+    whole contact point sets.
+    """
+    normals = []
+    physics_engine.sprites[sprite].body.each_arbiter(lambda arbiter: normals.append(arbiter.normal.y))
+    return any(normal_y < 0 for normal_y in normals)
+
 
 class PlayerSprite(arcade.Sprite):
     """ Player Sprite """
-    def __init__(self,
-                 ladder_list: arcade.SpriteList,
-                 hit_box_algorithm):
+    def __init__(self, hit_box_algorithm, skin: str = PLAYER_SKIN):
         """ Init """
         # Let parent initialize
         super().__init__()
@@ -93,34 +687,12 @@ class PlayerSprite(arcade.Sprite):
         # Set our scale
         self.scale = SPRITE_SCALING_PLAYER
 
-        # Images from Kenney.nl's Character pack
-        # main_path = ":resources:images/animated_characters/female_adventurer/femaleAdventurer"
-        #main_path = ":resources:images/animated_characters/female_person/femalePerson"
-        main_path = ":resources:images/animated_characters/male_person/malePerson"
-        # main_path = ":resources:images/animated_characters/male_adventurer/maleAdventurer"
-        # main_path = ":resources:images/animated_characters/zombie/zombie"
-        # main_path = ":resources:images/animated_characters/robot/robot"
-
-        # Load textures for idle standing
-        self.idle_texture_pair = arcade.load_texture_pair(f"{main_path}_idle.png")
-        self.jump_texture_pair = arcade.load_texture_pair(f"{main_path}_jump.png")
-        self.fall_texture_pair = arcade.load_texture_pair(f"{main_path}_fall.png")
-
-        # Load textures for walking
-        self.walk_textures = []
-        for i in range(8):
-            texture = arcade.load_texture_pair(f"{main_path}_walk{i}.png")
-            self.walk_textures.append(texture)
-
-        # Load textures for climbing
-        self.climbing_textures = []
-        texture = arcade.load_texture(f"{main_path}_climb0.png")
-        self.climbing_textures.append(texture)
-        texture = arcade.load_texture(f"{main_path}_climb1.png")
-        self.climbing_textures.append(texture)
+        # All of the skin's frames, shared with every other sprite using it
+        self.skin = assets.skin(skin)
+        self.frames = self.skin.frames
 
         # Set the initial texture
-        self.texture = self.idle_texture_pair[0]
+        self.texture = self.frames[STATE_IDLE][RIGHT_FACING][0]
 
         # Hit box will be set based on the first image used.
         self.hit_box = self.texture.hit_box_points
@@ -135,9 +707,31 @@ class PlayerSprite(arcade.Sprite):
         self.x_odometer = 0
         self.y_odometer = 0
 
-        self.ladder_list = ladder_list
+        # Number of ladder sensor shapes we're touching, kept by the
+        # player/ladder collision handler
+        self.ladder_contacts = 0
         self.is_on_ladder = False
 
+    def ladder_contact(self, change: int):
+        """ Called when the player starts (+1) or stops (-1) touching a ladder """
+        self.ladder_contacts += change
+        self.set_on_ladder(self.ladder_contacts > 0)
+
+    def set_on_ladder(self, on_ladder: bool):
+        """ Switch between climbing and normal gravity """
+        if on_ladder == self.is_on_ladder:
+            return
+        self.is_on_ladder = on_ladder
+        if on_ladder:
+            self.pymunk.gravity = (0, 0)
+            self.pymunk.damping = 0.0001
+            self.pymunk.max_vertical_velocity = PLAYER_MAX_HORIZONTAL_SPEED
+        else:
+            self.pymunk.damping = 1.0
+            self.pymunk.max_vertical_velocity = PLAYER_MAX_VERTICAL_SPEED
+            self.pymunk.gravity = None
+
+    @profiler.timed("player moved")
     def pymunk_moved(self, physics_engine, dx, dy, d_angle):
         """ Handle being moved by the pymunk engine """
         # Figure out if we need to face left or right
@@ -146,100 +740,1325 @@ class PlayerSprite(arcade.Sprite):
         elif dx > DEAD_ZONE and self.character_face_direction == LEFT_FACING:
             self.character_face_direction = RIGHT_FACING
 
-        # Are we on the ground?
-        is_on_ground = physics_engine.is_on_ground(self)
-
-        # Are we on a ladder?
-        if len(arcade.check_for_collision_with_list(self, self.ladder_list)) > 0:
-            if not self.is_on_ladder:
-                self.is_on_ladder = True
-                self.pymunk.gravity = (0, 0)
-                self.pymunk.damping = 0.0001
-                self.pymunk.max_vertical_velocity = PLAYER_MAX_HORIZONTAL_SPEED
-        else:
-            if self.is_on_ladder:
-                self.pymunk.damping = 1.0
-                self.pymunk.max_vertical_velocity = PLAYER_MAX_VERTICAL_SPEED
-                self.is_on_ladder = False
-                self.pymunk.gravity = None
-
         # Add to the odometer how far we've moved
         self.x_odometer += dx
         self.y_odometer += dy
 
+        # Standing still off a ladder is always the idle texture, whether
+        # or not we're on the ground
+        if not self.is_on_ladder and abs(dx) <= DEAD_ZONE and abs(dy) <= DEAD_ZONE:
+            self.texture = self.frames[STATE_IDLE][self.character_face_direction][0]
+            return
+
+        # Are we on the ground?
+        is_on_ground = is_grounded(physics_engine, self)
+
         if self.is_on_ladder and not is_on_ground:
+            state = STATE_CLIMB
             # Have we moved far enough to change the texture?
             if abs(self.y_odometer) > DISTANCE_TO_CHANGE_TEXTURE:
-
-                # Reset the odometer
                 self.y_odometer = 0
-
-                # Advance the walking animation
                 self.cur_texture += 1
+        elif not is_on_ground and dy > DEAD_ZONE:
+            state = STATE_JUMP
+        elif not is_on_ground and dy < -DEAD_ZONE:
+            state = STATE_FALL
+        elif abs(dx) <= DEAD_ZONE:
+            state = STATE_IDLE
+        elif abs(self.x_odometer) > DISTANCE_TO_CHANGE_TEXTURE:
+            state = STATE_WALK
+            self.x_odometer = 0
+            self.cur_texture += 1
+        else:
+            # Walking, but not far enough for the next frame yet
+            return
 
-            if self.cur_texture > 1:
+        textures = self.frames[state][self.character_face_direction]
+        if state in (STATE_WALK, STATE_CLIMB):
+            if self.cur_texture >= len(textures):
                 self.cur_texture = 0
-            self.texture = self.climbing_textures[self.cur_texture]
-            return
+            self.texture = textures[self.cur_texture]
+        else:
+            self.texture = textures[0]
 
-        # Jumping animation
-        if not is_on_ground:
-            if dy > DEAD_ZONE:
-                self.texture = self.jump_texture_pair[self.character_face_direction]
-                return
-            elif dy < -DEAD_ZONE:
-                self.texture = self.fall_texture_pair[self.character_face_direction]
-                return
 
-        # Idle animation
-        if abs(dx) <= DEAD_ZONE:
-            self.texture = self.idle_texture_pair[self.character_face_direction]
+class BulletSprite(arcade.SpriteSolidColor):
+    """ Bullet Sprite """
+
+
+class BulletPool:
+    """
+    A fixed set of bullets, each with its Pymunk body made once. Firing takes a
+    free bullet, or the oldest one in flight if they're all in use. Bullets come
+    back when they hit something, leave the map or run out of time.
+    """
+
+    def __init__(self, physics_engine: arcade.PymunkPhysicsEngine, bullet_list: arcade.SpriteList,
+                 size: int, map_width: float, map_height: float):
+        self.physics_engine = physics_engine
+        self.bullet_list = bullet_list
+        self.bounds = (-BULLET_CULL_MARGIN, -BULLET_CULL_MARGIN,
+                       map_width + BULLET_CULL_MARGIN, map_height + BULLET_CULL_MARGIN)
+        self.free = []
+        # Seconds left for each bullet in flight, oldest first
+        self.live = collections.OrderedDict()
+        self.physics_objects = {}
+        self.shapes = {}
+
+        for _ in range(size):
+            bullet = BulletSprite(20, 5, arcade.color.DARK_YELLOW)
+
+            # Gravity to use for the bullet
+            # If we don't use custom gravity, bullet drops too fast, or we have
+            # to make it go too fast.
+            # Force is in relation to bullet's angle.
+            bullet_gravity = (0, -BULLET_GRAVITY)
+
+            # Make the body and shape, then keep them out of the space until fired
+            physics_engine.add_sprite(bullet,
+                                      mass=BULLET_MASS,
+                                      damping=1.0,
+                                      friction=0.6,
+                                      collision_type="bullet",
+                                      gravity=bullet_gravity,
+                                      elasticity=0.9)
+            physics_object = physics_engine.sprites[bullet]
+            physics_engine.remove_sprite(bullet)
+            self.physics_objects[bullet] = physics_object
+            self.shapes[physics_object.shape] = bullet
+            self.free.append(bullet)
+
+    def fire(self, position, angle: float) -> BulletSprite:
+        """ Launch a bullet from a position, at an angle in degrees """
+        if not self.free:
+            self.release(next(iter(self.live)))
+        bullet = self.free.pop()
+
+        physics_object = self.physics_objects[bullet]
+        body = physics_object.body
+        body.position = position
+        body.angle = math.radians(angle)
+        body.velocity = (0, 0)
+        body.angular_velocity = 0
+        body.force = (0, 0)
+        bullet.position = position
+        bullet.angle = angle
+
+        self.physics_engine.space.add(body, physics_object.shape)
+        self.physics_engine.sprites[bullet] = physics_object
+        self.physics_engine.non_static_sprite_list.append(bullet)
+        self.bullet_list.append(bullet)
+        self.live[bullet] = BULLET_LIFETIME
+
+        # Add force to bullet
+        force = (BULLET_MOVE_FORCE, 0)
+        self.physics_engine.apply_force(bullet, force)
+        return bullet
+
+    def release(self, bullet: BulletSprite):
+        """ Take a bullet out of the game and back into the pool """
+        if bullet not in self.live:
+            return
+        del self.live[bullet]
+        self.physics_engine.remove_sprite(bullet)
+        self.bullet_list.remove(bullet)
+        self.free.append(bullet)
+
+    def release_all(self):
+        """ Bring back every bullet in flight """
+        for bullet in list(self.live):
+            self.release(bullet)
+
+    def update(self, delta_time: float):
+        """ Release bullets that have run out of time or left the map """
+        left, bottom, right, top = self.bounds
+        for bullet in list(self.live):
+            self.live[bullet] -= delta_time
+            # The body, as the sprite isn't kept up to date when running headless
+            x, y = self.physics_objects[bullet].body.position
+            if self.live[bullet] <= 0 or not (left < x < right and bottom < y < top):
+                self.release(bullet)
+
+
+class EntityStore:
+    """
+    Pickups and hazards kept in NumPy arrays, one entry per tile, instead of
+    as sprites. Entries are sorted by their left edge, so the ones that might
+    touch the player are a slice found by binary search and tested all at
+    once. Picking something up only clears its alive flag.
+    """
+    def __init__(self, compiled_level: "CompiledLevel"):
+        tiles = []
+        kinds = []
+        bounds = []
+        for layer_name, kind in ENTITY_LAYERS.items():
+            for tile in compiled_level.layers[layer_name]:
+                hit_box = self.place_hit_box(tile)
+                tiles.append(tile)
+                kinds.append(kind)
+                bounds.append((min(x for x, _ in hit_box), min(y for _, y in hit_box),
+                               max(x for x, _ in hit_box), max(y for _, y in hit_box)))
+        bounds = numpy.array(bounds, dtype=float).reshape(len(tiles), 4)
+        order = numpy.argsort(bounds[:, 0], kind="stable")
+
+        # The compiled tile of each entity has its texture, frames and hit box
+        self.tiles = [tiles[index] for index in order]
+        self.kind = numpy.array(kinds, dtype=numpy.uint8)[order]
+        self.position = numpy.array([tile.position for tile in self.tiles], dtype=float).reshape(len(tiles), 2)
+        self.left, self.bottom, self.right, self.top = bounds[order].T.copy()
+        self.alive = numpy.ones(len(tiles), dtype=bool)
+        # Widest entity, for how far left of a box to start looking
+        self.max_width = float((self.right - self.left).max(initial=0))
+        self.remaining = {kind: int((self.kind == kind).sum()) for kind in ENTITY_LAYERS.values()}
+        # Called with the index of each entity picked up, and with None on reset
+        self.listeners = []
+
+    def __len__(self):
+        return len(self.tiles)
+
+    @staticmethod
+    def place_hit_box(tile: "CompiledTile") -> list:
+        """ A tile's hit box in the map, worked out the way arcade does for a sprite """
+        x, y = tile.position
+        points = []
+        for point in tile.hit_box:
+            point = [point[0] * tile.scale, point[1] * tile.scale]
+            if tile.angle:
+                point = arcade.rotate_point(point[0], point[1], 0, 0, tile.angle)
+            points.append([point[0] + x, point[1] + y])
+        return points
+
+    def collisions(self, sprite: arcade.Sprite, kinds: int) -> numpy.ndarray:
+        """ Indexes of the live entities of some kinds that collide with a sprite """
+        # The sprite's edges, from one look at its hit box rather than one each
+        hit_box = sprite.get_adjusted_hit_box()
+        left, bottom, right, top = hit_box_bounds(hit_box)
+        start = numpy.searchsorted(self.left, left - self.max_width)
+        end = numpy.searchsorted(self.left, right, side="right")
+        near = (self.alive[start:end]
+                & ((self.kind[start:end] & kinds) != 0)
+                & (self.right[start:end] >= left)
+                & (self.bottom[start:end] <= top)
+                & (self.top[start:end] >= bottom))
+        candidates = numpy.flatnonzero(near) + start
+        if len(candidates) == 0:
+            return candidates
+        return numpy.array([index for index in candidates
+                            if arcade.are_polygons_intersecting(hit_box, self.place_hit_box(self.tiles[index]))],
+                           dtype=int)
+
+    def near(self, kinds: int, x: float, y: float, distance: float) -> bool:
+        """ Whether any live entity of some kinds has its center within a distance of a point """
+        indexes = numpy.flatnonzero(self.alive & ((self.kind & kinds) != 0))
+        offsets = self.position[indexes] - (x, y)
+        return bool((numpy.hypot(offsets[:, 0], offsets[:, 1]) < distance).any())
+
+    def kill(self, index: int):
+        """ Pick up or use up an entity """
+        if self.alive[index]:
+            self.alive[index] = False
+            self.remaining[int(self.kind[index])] -= 1
+            for listener in self.listeners:
+                listener(index)
+
+    def reset(self):
+        """ Bring back every entity """
+        self.alive[:] = True
+        for kind in self.remaining:
+            self.remaining[kind] = int((self.kind == kind).sum())
+        for listener in self.listeners:
+            listener(None)
+
+
+class MovingSprites:
+    """
+    Kinematic platforms and spikes, kept in NumPy arrays so turning them
+    around at their boundaries is worked out for all of them at once.
+
+    Positions follow the bodies by adding velocity * time step, the same
+    sum Pymunk does for kinematic bodies, so they are never read back.
+    Only bodies whose velocity changed are written to.
+    """
+
+    def __init__(self, physics_engine: arcade.PymunkPhysicsEngine, sprite_lists):
+        self.physics_engine = physics_engine
+        self.sprites = [sprite for sprite_list in sprite_lists for sprite in sprite_list]
+        self.bodies = [physics_engine.sprites[sprite].body for sprite in self.sprites]
+
+        # Frozen sprites stand still and are left out of the engine's sprite syncing
+        self.active = numpy.ones(len(self.sprites), dtype=bool)
+
+        # Boundaries as x and y columns, the right and top ones passed going up
+        # and the left and bottom ones going down. A boundary of None or 0 is
+        # not used, as with the per-sprite checks this replaces.
+        count = len(self.sprites)
+        self.upper_boundary = numpy.array([(sprite.boundary_right or 0.0, sprite.boundary_top or 0.0)
+                                           for sprite in self.sprites], dtype=float).reshape(count, 2)
+        lower_boundary = numpy.array([(sprite.boundary_left or 0.0, sprite.boundary_bottom or 0.0)
+                                      for sprite in self.sprites], dtype=float).reshape(count, 2)
+        self.has_upper_boundary = self.upper_boundary != 0
+        self.has_lower_boundary = lower_boundary != 0
+        # The left check matches the original per-sprite code, which compared
+        # with > too. Flipping the y column's sign, which is exact, turns the
+        # bottom check's < into the same >.
+        self.lower_sign = numpy.array([1.0, -1.0])
+        self.lower_boundary = lower_boundary * self.lower_sign
+
+        self.reset()
+
+    def reset(self):
+        """ Read the sprites' positions, directions and body velocities, after setup or restore """
+        count = len(self.sprites)
+        self.position = numpy.array([sprite.position for sprite in self.sprites], dtype=float).reshape(count, 2)
+        self.change = numpy.array([(sprite.change_x, sprite.change_y) for sprite in self.sprites],
+                                  dtype=float).reshape(count, 2)
+        self.velocity = numpy.array([tuple(body.velocity) for body in self.bodies], dtype=float).reshape(count, 2)
+
+        # How far each edge is from the center, right and top then left and
+        # bottom. Kinematic sprites never turn, so this stays put.
+        self.upper_extents = numpy.array([(sprite.right - sprite.center_x, sprite.top - sprite.center_y)
+                                          for sprite in self.sprites], dtype=float).reshape(count, 2)
+        self.lower_extents = numpy.array([(sprite.left - sprite.center_x, sprite.bottom - sprite.center_y)
+                                          for sprite in self.sprites], dtype=float).reshape(count, 2)
+
+    def update(self, delta_time: float):
+        """ Follow the physics step just taken, then turn around whatever passed a boundary """
+        if not self.sprites:
+            return
+        self.position += self.velocity * delta_time
+
+        # Both axes at once, as each costs the same few array operations
+        turn = ((self.has_upper_boundary & (self.change > 0) &
+                 (self.position + self.upper_extents > self.upper_boundary)) |
+                (self.has_lower_boundary & (self.change < 0) &
+                 ((self.position + self.lower_extents) * self.lower_sign > self.lower_boundary)))
+        turn &= self.active[:, numpy.newaxis]
+        self.change[turn] *= -1
+
+        # Pymunk uses velocity is in pixels per second, the map gives pixels per frame
+        velocity = self.change * MOVING_SPRITE_FRAME_RATE * self.active[:, numpy.newaxis]
+        for index in numpy.flatnonzero((velocity != self.velocity).any(axis=1)):
+            velocity_x, velocity_y = velocity[index].tolist()
+            self.bodies[index].velocity = (velocity_x, velocity_y)
+            sprite = self.sprites[index]
+            sprite.change_x, sprite.change_y = self.change[index].tolist()
+        self.velocity = velocity
+
+    def activate_region(self, left: float, bottom: float, right: float, top: float):
+        """ Freeze the sprites outside a region and unfreeze the ones inside it """
+        if not self.sprites:
             return
+        x = self.position[:, 0]
+        y = self.position[:, 1]
+        inside = (x > left) & (x < right) & (y > bottom) & (y < top)
+        non_static_sprite_list = self.physics_engine.non_static_sprite_list
+        for index in numpy.flatnonzero(inside != self.active):
+            if inside[index]:
+                non_static_sprite_list.append(self.sprites[index])
+            else:
+                non_static_sprite_list.remove(self.sprites[index])
+        # Velocities catch up on the next update
+        self.active = inside
+
+    def near(self, left: float, bottom: float, right: float, top: float, start: int = 0) -> list:
+        """ Indexes of the sprites from start on whose edges come within a pixel of a box, worth an exact check """
+        if len(self.sprites) <= start:
+            return []
+        upper = self.position[start:] + self.upper_extents[start:]
+        lower = self.position[start:] + self.lower_extents[start:]
+        close = ((upper[:, 0] >= left - 1) & (lower[:, 0] <= right + 1) &
+                 (upper[:, 1] >= bottom - 1) & (lower[:, 1] <= top + 1))
+        return (numpy.flatnonzero(close) + start).tolist()
+
+    def place_sprites(self, indexes):
+        """ Move the unfrozen ones of some sprites to their bodies, as the engine's sprite syncing does """
+        for index in indexes:
+            if self.active[index]:
+                self.sprites[index].position = self.bodies[index].position
+
+
+class ActivationRegion:
+    """
+    Keeps physics going only near the screen. Dynamic items further than
+    ACTIVATION_MARGIN away are put to sleep and moving sprites frozen, and
+    they wake when the view comes back within the margin.
+    """
+
+    def __init__(self, physics_engine: arcade.PymunkPhysicsEngine, item_list: arcade.SpriteList,
+                 moving_sprites: MovingSprites):
+        self.physics_engine = physics_engine
+        self.item_list = item_list
+        self.moving_sprites = moving_sprites
+        self.checked_view = None
+        self.time_since_check = 0.0
+
+    def update(self, view_left: float, view_bottom: float, delta_time: float):
+        """ Wake and sleep things for the current view, if it's time to check again """
+        self.time_since_check += delta_time
+        if self.checked_view is not None and self.time_since_check < ACTIVATION_INTERVAL and \
+                abs(view_left - self.checked_view[0]) < ACTIVATION_MARGIN / 2 and \
+                abs(view_bottom - self.checked_view[1]) < ACTIVATION_MARGIN / 2:
+            return
+        self.checked_view = (view_left, view_bottom)
+        self.time_since_check = 0.0
+
+        left = view_left - ACTIVATION_MARGIN
+        bottom = view_bottom - ACTIVATION_MARGIN
+        right = view_left + SCREEN_WIDTH + ACTIVATION_MARGIN
+        top = view_bottom + SCREEN_HEIGHT + ACTIVATION_MARGIN
+        for item in self.item_list:
+            body = self.physics_engine.sprites[item].body
+            x, y = body.position
+            if left < x < right and bottom < y < top:
+                if body.is_sleeping:
+                    body.activate()
+            elif not body.is_sleeping:
+                body.sleep()
+        self.moving_sprites.activate_region(left, bottom, right, top)
+
+    def reset(self):
+        """ Check again on the next update, after a restore """
+        self.checked_view = None
+
+
+class KeyLockSystem:
+    """
+    Every key/lock layer pair in a level. A pair is only looked at while it
+    can still do something: a loose key is tested against the player, a
+    carried key only against its own lock, and an opened pair not at all.
+    """
+    def __init__(self, pairs):
+        self.keys = [keys for keys, locks in pairs]
+        self.locks = [locks for keys, locks in pairs]
+        self.reset()
+
+    def reset(self):
+        """ Forget carried and opened keys, for a fresh start of the level """
+        # Pairs whose key is still lying in the level
+        self.loose = list(range(len(self.keys)))
+        # (pair, key sprite) for every key the player is carrying
+        self.carried = []
+        # Where each pair's keys and locks lie, worked out on the next update
+        # once the level has put them back
+        self.key_bounds = {}
+        self.lock_bounds = {}
+        # Edges of each carried key from its center, as it goes wherever the player does
+        self.key_extents = {}
+
+    def update(self, player: arcade.Sprite) -> int:
+        """
+        Pick up keys and open locks. Returns how many keys were picked up.
+        """
+        picked_up = 0
+        carried_keys = {key for _pair, key in self.carried}
+        player_left, player_bottom, player_right, player_top = hit_box_bounds(player.get_adjusted_hit_box())
+        still_loose = []
+        for pair in self.loose:
+            if not self.keys[pair]:
+                continue
+            if pair not in self.key_bounds:
+                self.key_bounds[pair] = hit_box_bounds([point for key in self.keys[pair]
+                                                        for point in key.get_adjusted_hit_box()])
+            left, bottom, right, top = self.key_bounds[pair]
+            if player_right < left or player_left > right or player_top < bottom or player_bottom > top:
+                still_loose.append(pair)
+                continue
+            for key in arcade.check_for_collision_with_list(player, self.keys[pair]):
+                if key not in carried_keys:
+                    self.carried.append((pair, key))
+                    carried_keys.add(key)
+                    key_left, key_bottom, key_right, key_top = hit_box_bounds(key.get_adjusted_hit_box())
+                    self.key_extents[key] = (key_left - key.center_x, key_bottom - key.center_y,
+                                             key_right - key.center_x, key_top - key.center_y)
+                    picked_up += 1
+            # A layer can have several keys, it's loose until all are carried
+            if any(key not in carried_keys for key in self.keys[pair]):
+                still_loose.append(pair)
+        self.loose = still_loose
+
+        opened = set()
+        player_x, player_y = player.position
+        for pair, key in list(self.carried):
+            if pair in opened or not self.locks[pair]:
+                continue
+            # The key is only moved to the player for an exact check once it's near its lock
+            if pair not in self.lock_bounds:
+                self.lock_bounds[pair] = hit_box_bounds([point for lock in self.locks[pair]
+                                                         for point in lock.get_adjusted_hit_box()])
+            left, bottom, right, top = self.lock_bounds[pair]
+            key_left, key_bottom, key_right, key_top = self.key_extents[key]
+            if player_x + key_right < left or player_x + key_left > right or \
+                    player_y + key_top < bottom or player_y + key_bottom > top:
+                continue
+            key.position = player.position
+            key_left, key_bottom, key_right, key_top = hit_box_bounds(key.get_adjusted_hit_box())
+            for lock in self.locks[pair]:
+                if key_right < lock.left or key_left > lock.right or \
+                        key_top < lock.bottom or key_bottom > lock.top:
+                    continue
+                if arcade.check_for_collision(key, lock):
+                    # The key opens the whole lock, and the lock and every
+                    # key of its layer are gone for good
+                    for lock_sprite in list(self.locks[pair]):
+                        lock_sprite.remove_from_sprite_lists()
+                    for key_sprite in list(self.keys[pair]):
+                        key_sprite.remove_from_sprite_lists()
+                    opened.add(pair)
+                    break
+
+        if opened:
+            self.carried = [(pair, key) for pair, key in self.carried if pair not in opened]
+            self.loose = [pair for pair in self.loose if pair not in opened]
+        return picked_up
+
+    def follow(self, player: arcade.Sprite):
+        """ Bring the carried keys along with the player, to be drawn """
+        for _pair, key in self.carried:
+            key.position = player.position
+
+    def draw(self):
+        """ Draw each lock with its key on top """
+        for keys, locks in zip(self.keys, self.locks):
+            locks.draw()
+            keys.draw()
+
+
+class AnimationScheduler:
+    """
+    The tiles that have animation frames, from any layer, advanced on one
+    clock. Tiles with the same frames are grouped and their frame is worked
+    out once for the whole group, so layers without animations cost nothing.
+    """
+    def __init__(self):
+        # Frames (texture name, duration) -> group of sprites showing them,
+        # the sprites kept as dict keys so taking one out is quick
+        self.groups = {}
+        self.clock = 0.0
+
+    def add(self, sprite: arcade.AnimatedTimeBasedSprite):
+        """ Animate a sprite along with any others that have the same frames """
+        key = tuple((frame.texture.name, frame.duration) for frame in sprite.frames)
+        # Tiled allows frames of no length, an animation of nothing but those stays still
+        if sum(duration for _name, duration in key) <= 0:
+            return
+        group = self.groups.get(key)
+        if group is None:
+            # When each frame ends, in seconds from the start of the animation
+            ends = list(itertools.accumulate(frame.duration / 1000 for frame in sprite.frames))
+            group = self.groups[key] = {"textures": [frame.texture for frame in sprite.frames],
+                                        "ends": ends,
+                                        "sprites": {},
+                                        "frame": 0}
+        group["sprites"][sprite] = None
+        # A sprite added again after a while may be showing any frame
+        sprite.texture = group["textures"][group["frame"]]
+
+    def remove(self, sprite: arcade.AnimatedTimeBasedSprite):
+        """ Stop animating a sprite """
+        key = tuple((frame.texture.name, frame.duration) for frame in sprite.frames)
+        group = self.groups.get(key)
+        if group is not None:
+            group["sprites"].pop(sprite, None)
+
+    def reset(self):
+        """ Start every animation again from its first frame """
+        self.clock = 0.0
+        for group in self.groups.values():
+            self.show(group, 0)
+
+    def show(self, group: dict, frame: int):
+        """ Set the texture of every sprite in a group """
+        group["frame"] = frame
+        texture = group["textures"][frame]
+        for sprite in group["sprites"]:
+            sprite.texture = texture
+
+    def update(self, delta_time: float):
+        """ Move the clock on, changing textures only for groups whose frame changed """
+        self.clock += delta_time
+        for group in self.groups.values():
+            ends = group["ends"]
+            frame = bisect.bisect_right(ends, self.clock % ends[-1])
+            if frame != group["frame"]:
+                self.show(group, frame)
+
+
+class ChunkedLayer:
+    """
+    Static tile layers split into square chunks of the map when the level is
+    loaded. Only chunks that overlap the screen are drawn, so the cost of
+    drawing doesn't grow with the size of the map.
+    """
+    def __init__(self, sprite_lists, chunk_size: float):
+        self.chunk_size = chunk_size
+        self.chunks = {}
+        # Sprites are put in the chunk holding their center, so look this
+        # much past the edge of the screen for ones that stick out of a chunk.
+        self.margin = 0
+        for sprite_list in sprite_lists:
+            for sprite in sprite_list:
+                chunk = (int(sprite.center_x // chunk_size), int(sprite.center_y // chunk_size))
+                if chunk not in self.chunks:
+                    self.chunks[chunk] = arcade.SpriteList(is_static=True)
+                self.chunks[chunk].append(sprite)
+                self.margin = max(self.margin, sprite.width / 2, sprite.height / 2)
+
+    def draw(self, left: float, bottom: float) -> int:
+        """ Draw the chunks on a screen with this lower left corner """
+        first_column = int((left - self.margin) // self.chunk_size)
+        last_column = int((left + SCREEN_WIDTH + self.margin) // self.chunk_size)
+        first_row = int((bottom - self.margin) // self.chunk_size)
+        last_row = int((bottom + SCREEN_HEIGHT + self.margin) // self.chunk_size)
+        draw_calls = 0
+        for column in range(first_column, last_column + 1):
+            for row in range(first_row, last_row + 1):
+                chunk = self.chunks.get((column, row))
+                if chunk is not None:
+                    chunk.draw()
+                    draw_calls += 1
+        return draw_calls
+
+
+class EntityLayer:
+    """
+    Draws some kinds of entity from an EntityStore. Sprites are made for a
+    chunk of the map the first time it comes on screen, and kept from then
+    on, so each chunk's list fills its texture atlas once. Something picked
+    up is hidden in its chunk, and stops being animated, rather than taken
+    out of it.
+    """
+    def __init__(self, store: EntityStore, kinds: int, chunk_size: float, animations: AnimationScheduler):
+        self.store = store
+        self.chunk_size = chunk_size
+        self.animations = animations
+        # Entity indexes in each chunk, by the chunk holding their center
+        self.chunks = {}
+        self.margin = 0
+        for index in numpy.flatnonzero((store.kind & kinds) != 0):
+            x, y = store.position[index]
+            self.chunks.setdefault((int(x // chunk_size), int(y // chunk_size)), []).append(index)
+            tile = store.tiles[index]
+            self.margin = max(self.margin, tile.width / 2, tile.height / 2)
+        # Chunks with sprites
+        self.built = {}
+        # Sprite of each entity in a built chunk, shown or hidden
+        self.sprites = {}
+        self.hidden = {}
+        store.listeners.append(self.entity_killed)
+
+    def build(self, chunk: tuple) -> arcade.SpriteList:
+        """ Make the sprites for a chunk's entities, with the ones already picked up hidden """
+        # Not static, a static list never uploads the hidden sprites' alpha
+        sprite_list = arcade.SpriteList()
+        for index in self.chunks[chunk]:
+            sprite = self.store.tiles[index].create_sprite()
+            sprite_list.append(sprite)
+            if self.store.alive[index]:
+                self.show(index, sprite)
+            else:
+                self.hide(index, sprite)
+        return sprite_list
+
+    def show(self, index: int, sprite: arcade.Sprite):
+        """ Show an entity's sprite and animate it """
+        sprite.alpha = self.store.tiles[index].alpha
+        if getattr(sprite, "frames", None):
+            self.animations.add(sprite)
+        self.sprites[index] = sprite
+
+    def hide(self, index: int, sprite: arcade.Sprite):
+        """ Hide an entity's sprite and stop animating it """
+        sprite.alpha = 0
+        if getattr(sprite, "frames", None):
+            self.animations.remove(sprite)
+        self.hidden[index] = sprite
+
+    def entity_killed(self, index: Optional[int]):
+        """ Hide a picked up entity, or show every hidden one again when they all come back """
+        if index is None:
+            hidden, self.hidden = self.hidden, {}
+            for index, sprite in hidden.items():
+                self.show(index, sprite)
+        elif index in self.sprites:
+            self.hide(index, self.sprites.pop(index))
+
+    def draw(self, left: float, bottom: float) -> int:
+        """ Draw the chunks on a screen with this lower left corner """
+        first_column = int((left - self.margin) // self.chunk_size)
+        last_column = int((left + SCREEN_WIDTH + self.margin) // self.chunk_size)
+        first_row = int((bottom - self.margin) // self.chunk_size)
+        last_row = int((bottom + SCREEN_HEIGHT + self.margin) // self.chunk_size)
+        draw_calls = 0
+        for column in range(first_column, last_column + 1):
+            for row in range(first_row, last_row + 1):
+                chunk = (column, row)
+                if chunk not in self.chunks:
+                    continue
+                sprite_list = self.built.get(chunk)
+                if sprite_list is None:
+                    sprite_list = self.built[chunk] = self.build(chunk)
+                sprite_list.draw()
+                draw_calls += 1
+        return draw_calls
+
+
+def make_background_tiles(image_path: str) -> str:
+    """
+    Cut a background image into BACKGROUND_TILE_PIXELS square tiles for every
+    mip level, saved as "<level>_<column>_<row>.png" with row 0 at the bottom.
+    Only done again if the image is newer than the tiles. Returns the
+    directory the tiles are in.
+    """
+    tile_directory = os.path.splitext(image_path)[0] + "_tiles"
+    done_file = os.path.join(tile_directory, "done")
+    if os.path.exists(done_file) and os.path.getmtime(done_file) >= os.path.getmtime(image_path):
+        return tile_directory
+
+    os.makedirs(tile_directory, exist_ok=True)
+    image = PIL.Image.open(image_path).convert("RGBA")
+    for level in range(BACKGROUND_MIP_LEVELS):
+        if level > 0:
+            image = image.reduce(2)
+        for column in range(math.ceil(image.width / BACKGROUND_TILE_PIXELS)):
+            for row in range(math.ceil(image.height / BACKGROUND_TILE_PIXELS)):
+                left = column * BACKGROUND_TILE_PIXELS
+                bottom = image.height - row * BACKGROUND_TILE_PIXELS
+                tile = image.crop((left, max(bottom - BACKGROUND_TILE_PIXELS, 0),
+                                   min(left + BACKGROUND_TILE_PIXELS, image.width), bottom))
+                tile.save(os.path.join(tile_directory, f"{level}_{column}_{row}.png"))
+
+    with open(done_file, "w"):
+        pass
+    return tile_directory
+
+
+class TextureCache:
+    """ Least recently used textures, kept under a memory budget in bytes """
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.used = 0
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        """ Get an entry and mark it as just used, or None if it isn't loaded """
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry, size: int):
+        """ Add an entry, dropping the least recently used ones to make room """
+        self.entries[key] = (entry, size)
+        self.used += size
+        while self.used > self.budget and len(self.entries) > 1:
+            _key, (_entry, old_size) = self.entries.popitem(last=False)
+            self.used -= old_size
+
+
+class StreamedBackground:
+    """
+    A huge background image drawn from its tiles. Only the tiles around the
+    screen are loaded, on a worker thread, and ones further along the way the
+    camera is moving are loaded ahead of time. Until a tile is ready, the
+    matching piece of a smaller mip level is stretched over its place.
+    """
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+
+    def __init__(self, image_path: str, left: float, bottom: float,
+                 budget: int = BACKGROUND_TEXTURE_BUDGET):
+        self.tile_directory = make_background_tiles(image_path)
+        with PIL.Image.open(image_path) as image:
+            self.width, self.height = image.size
+        self.left = left
+        self.bottom = bottom
+        # Tiles already loaded are shared with any other view of this background
+        self.cache = assets.background(image_path, left, bottom, budget)
+        self.loading = {}
+        # Tiles asked for during this draw, any others still loading are dropped
+        self.requested = set()
+        self.last_view = (0, 0)
+
+    def _tile_range(self, level, left, bottom, right, top):
+        """ Columns and rows of the tiles in a mip level that cover an area """
+        size = BACKGROUND_TILE_PIXELS * 2 ** level
+        columns = math.ceil(self.width / size)
+        rows = math.ceil(self.height / size)
+        first_column = max(int((left - self.left) // size), 0)
+        last_column = min(int((right - self.left) // size), columns - 1)
+        first_row = max(int((bottom - self.bottom) // size), 0)
+        last_row = min(int((top - self.bottom) // size), rows - 1)
+        return [(column, row)
+                for column in range(first_column, last_column + 1)
+                for row in range(first_row, last_row + 1)]
+
+    @staticmethod
+    def _load_image(path):
+        """ Decode one tile, run on the worker thread """
+        with PIL.Image.open(path) as image:
+            return image.convert("RGBA")
+
+    def _get_tile(self, level, column, row) -> Optional[arcade.SpriteList]:
+        """ Get a tile ready to draw, or start loading it if it isn't """
+        key = (level, column, row)
+        self.requested.add(key)
+        entry = self.cache.get(key)
+        if entry is not None:
+            return entry[0]
+
+        future = self.loading.get(key)
+        if future is None:
+            path = os.path.join(self.tile_directory, f"{level}_{column}_{row}.png")
+            self.loading[key] = self.executor.submit(self._load_image, path)
+            return None
+        if not future.done():
+            return None
+
+        del self.loading[key]
+        image = future.result()
+        size = BACKGROUND_TILE_PIXELS * 2 ** level
+        sprite = arcade.Sprite(scale=2 ** level)
+        sprite.texture = arcade.Texture(f"{self.tile_directory}-{level}-{column}-{row}", image)
+        sprite.left = self.left + column * size
+        sprite.bottom = self.bottom + row * size
+        tile = arcade.SpriteList(is_static=True)
+        tile.append(sprite)
+        self.cache.put(key, tile, image.width * image.height * 4)
+        return tile
+
+    def draw(self, left: float, bottom: float) -> int:
+        """ Draw the tiles on a screen with this lower left corner """
+        right = left + SCREEN_WIDTH
+        top = bottom + SCREEN_HEIGHT
+
+        # Ask for the tiles just past the screen in the direction of travel
+        ahead = BACKGROUND_TILE_PIXELS * BACKGROUND_PREFETCH_TILES
+        move_x = left - self.last_view[0]
+        move_y = bottom - self.last_view[1]
+        self.last_view = (left, bottom)
+        prefetch_area = (left - ahead if move_x < 0 else left,
+                         bottom - ahead if move_y < 0 else bottom,
+                         right + ahead if move_x > 0 else right,
+                         top + ahead if move_y > 0 else top)
+        for column, row in self._tile_range(0, *prefetch_area):
+            self._get_tile(0, column, row)
+
+        # Work out which tiles are ready, and what to draw where they aren't
+        ready = []
+        missing = []
+        for column, row in self._tile_range(0, left, bottom, right, top):
+            tile = self._get_tile(0, column, row)
+            if tile is not None:
+                ready.append(tile)
+            else:
+                missing.append((column, row))
+
+        stand_ins = []
+        for column, row in missing:
+            for level in range(1, BACKGROUND_MIP_LEVELS):
+                scale = 2 ** level
+                tile = self._get_tile(level, column // scale, row // scale)
+                if tile is not None:
+                    if tile not in stand_ins:
+                        stand_ins.append(tile)
+                    break
+
+        # Tiles that scrolled out of range before they loaded aren't wanted
+        # any more, so scrolling fast doesn't pile up decoding work
+        for key in [key for key in self.loading if key not in self.requested]:
+            self.loading.pop(key).cancel()
+        self.requested.clear()
+
+        for tile in stand_ins + ready:
+            tile.draw()
+        return len(stand_ins) + len(ready)
+
+
+class RenderPipeline:
+    """
+    Draws a level's layers in order. A group of static tile layers given as a
+    list becomes one ChunkedLayer, so the group shares a texture atlas per
+    chunk and only the chunks on screen are drawn.
+    """
+    def __init__(self, layers, chunk_size: float):
+        self.batches = []
+        for layer in layers:
+            if isinstance(layer, list):
+                layer = ChunkedLayer(layer, chunk_size)
+            self.batches.append(layer)
+
+    def draw(self, left: float, bottom: float) -> int:
+        """ Draw every batch. Returns how many draw calls were made. """
+        draw_calls = 0
+        for batch in self.batches:
+            if isinstance(batch, (ChunkedLayer, EntityLayer, StreamedBackground)):
+                draw_calls += batch.draw(left, bottom)
+            else:
+                batch.draw()
+                draw_calls += 1
+        return draw_calls
+
+
+class HudText:
+    """ A line of HUD text, only turned into a new image when it changes """
+    def __init__(self, sprite_list: arcade.SpriteList, color, font_size: float):
+        self.color = color
+        self.font_size = font_size
+        self.text = None
+        self.sprite = arcade.Sprite()
+        sprite_list.append(self.sprite)
+
+    def update(self, text: str, x: float, y: float):
+        """ Set the text and where its bottom left corner goes """
+        if text != self.text:
+            self.text = text
+            image = arcade.get_text_image(text=text,
+                                          text_color=self.color,
+                                          font_size=self.font_size)
+            self.sprite.texture = arcade.Texture(f"hud-{text}-{self.color}-{self.font_size}", image)
+        self.sprite.position = (x + self.sprite.width / 2, y + self.sprite.height / 2)
+
+
+class PerformanceOverlay:
+    """ Frame time graph, phase timings and object counts, drawn over the game """
+
+    def __init__(self):
+        self.visible = False
+        self.text_list = arcade.SpriteList()
+        # The text changes on every refresh, so don't keep the old textures
+        self.text_list._keep_textures = False
+        self.lines = [HudText(self.text_list, arcade.color.WHITE, 12) for _ in range(6)]
+        self.texts = [""] * len(self.lines)
+        self.refreshed = 0.0
+
+    def refresh(self, game_view: "GameWindow"):
+        """ Work out the text from the profiler's recent events """
+        frame_times = sorted(profiler.frame_times()) or [0.0]
+        totals = collections.Counter()
+        gc_pauses = []
+        for name, start, end, thread in profiler.recent(1.0):
+            if name.startswith("gc "):
+                gc_pauses.append(end - start)
+            else:
+                totals[name] += end - start
+        frames = max(1, len([start for start in profiler.frame_starts if start >= time.perf_counter() - 1.0]))
+        sprites = sum(len(sprite_list) for sprite_list in vars(game_view).values()
+                      if isinstance(sprite_list, arcade.SpriteList))
+        asset_stats = assets.stats()
+
+        def per_frame(name):
+            return totals[name] / frames * 1000
+
+        self.texts = [
+            f"Frame {frame_times[len(frame_times) // 2] * 1000:.1f} ms median, {frame_times[-1] * 1000:.1f} ms max",
+            f"Update {per_frame('update'):.2f} ms: physics {per_frame('physics step'):.2f}, "
+            f"player {per_frame('player moved'):.2f}, movers {per_frame('moving sprites'):.2f}, "
+            f"collisions {per_frame('collisions'):.2f}, keys {per_frame('key/lock'):.2f}",
+            f"Draw {per_frame('draw'):.2f} ms: layers {per_frame('draw layers'):.2f}, "
+            f"{game_view.draw_calls} draw calls",
+            f"{sprites} sprites, {len(game_view.entities)} entities, "
+            f"{len(game_view.physics_engine.space.shapes)} physics shapes",
+            f"Assets: {asset_stats['loaded']} loaded, {asset_stats['hits']} hits, {asset_stats['misses']} misses",
+            f"{len(gc_pauses)} GC pauses in the last second, longest {max(gc_pauses, default=0) * 1000:.2f} ms",
+        ]
+
+    def draw(self, game_view: "GameWindow"):
+        if time.perf_counter() - self.refreshed > OVERLAY_REFRESH:
+            self.refresh(game_view)
+            self.refreshed = time.perf_counter()
+
+        left = game_view.view_left + 10
+        top = game_view.view_bottom + SCREEN_HEIGHT - 10
+        arcade.draw_lrtb_rectangle_filled(left - 5, left + 600, top + 5, top - 210, (0, 0, 0, 160))
+
+        # Frame time graph, with a line at 60 fps
+        graph_bottom = top - 200
+        frame_times = profiler.frame_times()
+        points = [(left + index * 4, graph_bottom + min(frame_time, OVERLAY_GRAPH_MAX) / OVERLAY_GRAPH_MAX * 80)
+                  for index, frame_time in enumerate(frame_times)]
+        if len(points) > 1:
+            arcade.draw_line_strip(points, arcade.color.GREEN)
+        target = graph_bottom + (1 / 60) / OVERLAY_GRAPH_MAX * 80
+        arcade.draw_line(left, target, left + 480, target, arcade.color.YELLOW)
+
+        for index, (line, text) in enumerate(zip(self.lines, self.texts)):
+            line.update(text, left, top - 20 * (index + 1))
+        self.text_list.draw()
+
+
+class CompiledTile:
+    """ Everything needed to re-create one map sprite without the TMX parser """
+    __slots__ = ("texture", "frames", "scale", "width", "height", "position",
+                 "angle", "alpha", "hit_box", "change", "boundaries", "properties")
+
+    def __init__(self, sprite: arcade.Sprite, trace_hit_box: bool):
+        self.texture = sprite.texture
+        self.frames = getattr(sprite, "frames", None)
+        self.scale = sprite.scale
+        self.width = sprite.width
+        self.height = sprite.height
+        self.position = sprite.position
+        self.angle = sprite.angle
+        self.alpha = sprite.alpha
+        # Asking for the hit box traces it now, so it is never traced again.
+        # Layers that never collide keep the lazy hit box from the texture.
+        self.hit_box = None
+        if trace_hit_box:
+            self.hit_box = tuple(tuple(point) for point in sprite.get_hit_box())
+        self.change = (sprite.change_x, sprite.change_y)
+        self.boundaries = (sprite.boundary_left, sprite.boundary_right,
+                           sprite.boundary_top, sprite.boundary_bottom)
+        self.properties = dict(sprite.properties)
+
+    def create_sprite(self) -> arcade.Sprite:
+        """ Make a fresh sprite from the compiled data """
+        if self.frames:
+            sprite = arcade.AnimatedTimeBasedSprite(scale=self.scale)
+            sprite.frames = self.frames
+        else:
+            sprite = arcade.Sprite(scale=self.scale)
+        sprite.texture = self.texture
+        sprite.width = self.width
+        sprite.height = self.height
+        if self.hit_box is not None:
+            sprite.set_hit_box(self.hit_box)
+        sprite.position = self.position
+        sprite.angle = self.angle
+        if self.alpha != 255:
+            sprite.alpha = self.alpha
+        sprite.change_x, sprite.change_y = self.change
+        (sprite.boundary_left, sprite.boundary_right,
+         sprite.boundary_top, sprite.boundary_bottom) = self.boundaries
+        sprite.properties = dict(self.properties)
+        return sprite
+
+
+def find_backgrounds(my_map, map_name: str, layer_name: str) -> list:
+    """
+    The (image path, left, bottom) of every background image in a layer,
+    with each image cut into tiles for StreamedBackground
+    """
+    backgrounds = []
+    layer = arcade.tilemap.get_tilemap_layer(my_map, layer_name)
+    if layer is None:
+        return backgrounds
+    for row_index, row in enumerate(layer.layer_data):
+        for column_index, gid in enumerate(row):
+            # Strip Tiled's flip flags from the tile number
+            gid &= 0x1FFFFFFF
+            if gid == 0:
+                continue
+            for first_gid, tileset in my_map.tile_sets.items():
+                if tileset.tiles and gid - first_gid in tileset.tiles:
+                    image = tileset.tiles[gid - first_gid].image
+                    image_path = os.path.join(os.path.dirname(map_name), image.source)
+                    make_background_tiles(image_path)
+                    backgrounds.append((image_path,
+                                        column_index * my_map.tile_size[0],
+                                        (my_map.map_size.height - row_index - 1) * my_map.tile_size[1]))
+                    break
+    return backgrounds
+
+
+def merge_wall_tiles(tiles):
+    """
+    Merge tiles with rectangular hit boxes into as few rectangles as possible.
+    Touching tiles in a row with the same top and bottom become one strip, then
+    strips stacked with the same left and right become one rectangle.
+
+    Returns the (left, bottom, right, top) rectangles and the indexes of the
+    tiles that could not be merged, such as slopes.
+    """
+    strips = {}
+    unmerged = []
+    for index, tile in enumerate(tiles):
+        points = [(x * tile.scale + tile.position[0], y * tile.scale + tile.position[1])
+                  for x, y in tile.hit_box]
+        left = min(x for x, y in points)
+        right = max(x for x, y in points)
+        bottom = min(y for x, y in points)
+        top = max(y for x, y in points)
+
+        area = 0
+        for (x1, y1), (x2, y2) in zip(points, points[1:] + points[:1]):
+            area += x1 * y2 - x2 * y1
+        if tile.angle or abs(area) / 2 < (right - left) * (top - bottom) * RECTANGLE_FILL:
+            unmerged.append(index)
+            continue
+
+        strips.setdefault((round(bottom), round(top)), []).append([left, right])
+
+    # Join tiles that touch side by side
+    columns = {}
+    for (bottom, top), spans in strips.items():
+        spans.sort()
+        merged_spans = [spans[0]]
+        for left, right in spans[1:]:
+            if left - merged_spans[-1][1] <= 1:
+                merged_spans[-1][1] = max(merged_spans[-1][1], right)
+            else:
+                merged_spans.append([left, right])
+        for left, right in merged_spans:
+            columns.setdefault((round(left), round(right)), []).append([bottom, top])
+
+    # Join strips that sit on top of each other
+    rectangles = []
+    for (left, right), spans in columns.items():
+        spans.sort()
+        merged_spans = [spans[0]]
+        for bottom, top in spans[1:]:
+            if bottom - merged_spans[-1][1] <= 1:
+                merged_spans[-1][1] = max(merged_spans[-1][1], top)
+            else:
+                merged_spans.append([bottom, top])
+        for bottom, top in merged_spans:
+            rectangles.append((left, bottom, right, top))
 
-        # Have we moved far enough to change the texture?
-        if abs(self.x_odometer) > DISTANCE_TO_CHANGE_TEXTURE:
+    return rectangles, unmerged
 
-            # Reset the odometer
-            self.x_odometer = 0
 
-            # Advance the walking animation
-            self.cur_texture += 1
-            if self.cur_texture > 7:
-                self.cur_texture = 0
-            self.texture = self.walk_textures[self.cur_texture][self.character_face_direction]
+def find_key_lock_numbers(my_map) -> list:
+    """ Find every key/lock pair, whichever half of it is in the map """
+    return sorted({int(match.group(2))
+                   for match in (KEY_LOCK_LAYER.match(layer.name) for layer in my_map.layers)
+                   if match})
+
+
+def level_layers(key_lock_numbers: list) -> list:
+    """ LEVEL_LAYERS, plus the key and lock layers of a level with the given key/lock pairs """
+    layers = list(LEVEL_LAYERS)
+    for number in key_lock_numbers:
+        layers.append((None, f"Key {number}", KEY_LAYER_OPTIONS))
+        layers.append((None, f"Lock {number}", LOCK_LAYER_OPTIONS))
+    return layers
+
+
+class CompiledLevel:
+    """
+    A level read from its TMX file once, with tile positions, textures and
+    hit boxes already worked out for every layer in LEVEL_LAYERS.
+    """
+    def __init__(self, map_name: str):
+        self.map_name = map_name
+        self.mtime = os.path.getmtime(map_name)
+        self.layers = {}
+        self.spatial_hash = {}
+
+        my_map = arcade.tilemap.read_tmx(map_name)
+        self.map_width = my_map.map_size.width
+        self.map_height = my_map.map_size.height
+        self.tile_size = my_map.tile_size[0] * SPRITE_SCALING_TILES
+
+        self.key_lock_numbers = find_key_lock_numbers(my_map)
+        layers = level_layers(self.key_lock_numbers)
+
+        # The background is only found here, its huge images are streamed
+        # in tiles when drawing rather than loaded as sprites
+        self.backgrounds = find_backgrounds(my_map, map_name, "Background")
+
+        for _attribute, layer_name, options in layers:
+            sprite_list = arcade.tilemap.process_layer(my_map, layer_name, **options)
+            trace_hit_box = "hit_box_algorithm" in options
+            self.layers[layer_name] = [CompiledTile(sprite, trace_hit_box) for sprite in sprite_list]
+            self.spatial_hash[layer_name] = options.get("use_spatial_hash")
+
+        # Only tiles with <animation> frames need animating
+        self.animated_tiles = {}
+        for layer_name, tiles in self.layers.items():
+            animated = [index for index, tile in enumerate(tiles) if tile.frames]
+            if animated:
+                self.animated_tiles[layer_name] = animated
+
+        # Work out the merged wall shapes once, rather than on every setup()
+        self.wall_rectangles = []
+        self.unmerged_walls = {}
+        for layer_name in MERGED_WALL_LAYERS:
+            rectangles, unmerged = merge_wall_tiles(self.layers[layer_name])
+            self.wall_rectangles.extend(rectangles)
+            self.unmerged_walls[layer_name] = unmerged
+
+        # Ladders are merged the same way, into sensor shapes
+        self.ladder_rectangles, self.unmerged_ladders = merge_wall_tiles(self.layers["Ladders"])
+
+        # Names of every texture the tiles use, in arcade's texture cache
+        self.texture_names = set()
+        for tiles in self.layers.values():
+            for tile in tiles:
+                self.texture_names.add(tile.texture.name)
+                for frame in tile.frames or ():
+                    self.texture_names.add(frame.texture.name)
+
+    def build_layer(self, layer_name: str) -> arcade.SpriteList:
+        """ Create a new sprite list for a layer """
+        sprite_list = arcade.SpriteList(use_spatial_hash=self.spatial_hash[layer_name])
+        for tile in self.layers[layer_name]:
+            sprite_list.append(tile.create_sprite())
+        return sprite_list
+
+
+# Held while compiling, so two threads never compile the same level
+_compile_lock = threading.Lock()
+
+
+def load_level(level: int) -> CompiledLevel:
+    """ Get the compiled level, reading the TMX again only if it was modified """
+    with _compile_lock:
+        compiled_level = assets.level(f"{PROJECT_PATH}/level_{level}.tmx")
+        hit_boxes.save()
+    return compiled_level
+
+
+# Loading that runs off the main thread so the menus keep drawing
+_loader = concurrent.futures.ThreadPoolExecutor(2)
+
+# Loader jobs that haven't finished yet
+_loader_jobs = set()
+
+# Game view being built ahead of time, as (level, future)
+_prebuilt_game_view = None
+
+
+def submit_load(function, *args) -> concurrent.futures.Future:
+    """ Run a job on the loader, keeping track of it until it's done """
+    future = _loader.submit(function, *args)
+    _loader_jobs.add(future)
+    future.add_done_callback(_loader_jobs.discard)
+    return future
+
+
+def release_unused_assets() -> bool:
+    """
+    Drop the assets nothing asked for since the last release, if it's safe.
+    Loader jobs load textures into arcade's cache, which the release trims,
+    so it only happens on the main thread while no job is running.
+    Returns whether the assets were released.
+    """
+    if _loader_jobs or threading.current_thread() is not threading.main_thread():
+        return False
+    assets.release_unused()
+    return True
+
+
+def load_title_layers() -> "RenderPipeline":
+    """ Read the title screen's map, ready to draw """
+    map_name = f"{PROJECT_PATH}/bg.tmx"
+    my_map = arcade.tilemap.read_tmx(map_name)
+    backgrounds = [StreamedBackground(image_path, left, bottom)
+                   for layer_name in TITLE_BACKGROUND_LAYERS
+                   for image_path, left, bottom in find_backgrounds(my_map, map_name, layer_name)]
+    layers = [arcade.tilemap.process_layer(my_map, layer_name) for layer_name in TITLE_LAYERS]
+    hit_boxes.save()
+    return RenderPipeline([*backgrounds, *layers], CHUNK_SIZE)
+
+
+def build_game_view(level: int) -> "GameWindow":
+    """ Create a game view with the level already set up """
+    game_view = GameWindow()
+    game_view.level = level
+    game_view.setup(level)
+    return game_view
+
+
+def prebuild_game_view(level: int):
+    """ Start building the game view for a level, unless it's already on its way """
+    global _prebuilt_game_view
+    if _prebuilt_game_view is None or _prebuilt_game_view[0] != level:
+        _prebuilt_game_view = (level, submit_load(build_game_view, level))
+
+
+def take_game_view(level: int) -> "GameWindow":
+    """ Hand over the prebuilt game view for a level, waiting for it if needed """
+    global _prebuilt_game_view
+    prebuild_game_view(level)
+    future = _prebuilt_game_view[1]
+    _prebuilt_game_view = None
+    return future.result()
+
+
+def release_game_view(game_view: "GameWindow"):
+    """
+    Take apart a game view that's no longer shown, a chunk at a time: first
+    its physics objects, then the sprites of every sprite list it draws from.
+    The view's other references to its sprites go first, so each chunk of
+    sprites taken out of the last list holding them is freed right there.
+    """
+    space = game_view.physics_engine.space
+    physics_objects = list(space.shapes) + list(space.bodies)
+    for start in range(0, len(physics_objects), RELEASE_CHUNK):
+        space.remove(*physics_objects[start:start + RELEASE_CHUNK])
+        yield
+    game_view.physics_engine.sprites.clear()
+    game_view.physics_engine.non_static_sprite_list.clear()
+
+    sprite_lists = [value for value in vars(game_view).values() if isinstance(value, arcade.SpriteList)]
+    sprite_lists += game_view.key_lock_system.keys + game_view.key_lock_system.locks
+    for batch in game_view.render_pipeline.batches:
+        if isinstance(batch, ChunkedLayer):
+            sprite_lists += batch.chunks.values()
+        elif isinstance(batch, EntityLayer):
+            sprite_lists += batch.built.values()
+    # Snapshots, moving sprite arrays, animations and the rest go with the view
+    vars(game_view).clear()
+    yield
+
+    for list_index, sprite_list in enumerate(sprite_lists):
+        # SpriteList.remove() re-indexes the whole list for every sprite, so
+        # chunks are cut off the end of it instead
+        while sprite_list.sprite_list:
+            chunk = sprite_list.sprite_list[-RELEASE_CHUNK:]
+            del sprite_list.sprite_list[-RELEASE_CHUNK:]
+            for sprite in chunk:
+                del sprite_list.sprite_idx[sprite]
+                sprite.sprite_lists.remove(sprite_list)
+                if sprite_list.spatial_hash is not None:
+                    sprite_list.spatial_hash.remove_object(sprite)
+            # Nothing here holds on to the chunk while waiting for the next step
+            del chunk, sprite
+            yield
+        sprite_lists[list_index] = sprite_list = None
+
+
+class ReleaseQueue:
+    """ Jobs, as generators, run a step at a time within a time budget each frame """
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.jobs = collections.deque()
+
+    def add(self, job):
+        """ Queue a job, which starts on the next update() """
+        self.jobs.append(job)
+
+    def update(self):
+        """ Run job steps until the frame's budget is used up """
+        deadline = time.perf_counter() + self.budget
+        while self.jobs and time.perf_counter() < deadline:
+            try:
+                next(self.jobs[0])
+            except StopIteration:
+                self.jobs.popleft()
+
+
+# Finished levels being taken apart
+retired_views = ReleaseQueue(RELEASE_BUDGET)
 
-class BulletSprite(arcade.SpriteSolidColor):
-    """ Bullet Sprite """
-    def pymunk_moved(self, physics_engine, dx, dy, d_angle):
-        """ Handle when the sprite is moved by the physics engine. """
-        # If the bullet falls below the screen, remove it
-        if self.center_y < -100:
-            self.remove_from_sprite_lists()
 
 class TitleView(arcade.View):
+    # Title screen layers, read once in the background
+    layers_future = None
 
     def __init__(self):
         super().__init__()
-        my_map = arcade.tilemap.read_tmx("/Users/mahirkhandokar/Desktop/Projects/the_legend_of_rakesh/bg.tmx")
-        self.grass = arcade.tilemap.process_layer(my_map, "Grass")
-        self.sand = arcade.tilemap.process_layer(my_map, "Sand")
-        self.snow = arcade.tilemap.process_layer(my_map, "Snow")
-        self.haunted = arcade.tilemap.process_layer(my_map, "Haunted")
-        self.city = arcade.tilemap.process_layer(my_map, "City")
-        self.ladders = arcade.tilemap.process_layer(my_map, "Ladders")
-        self.misc = arcade.tilemap.process_layer(my_map, "Misc.")
-        self.platforms = arcade.tilemap.process_layer(my_map, "Platforms")
+        if TitleView.layers_future is None:
+            TitleView.layers_future = submit_load(load_title_layers)
+        prebuild_game_view(LevelView.level)
+
+    def on_show(self):
+        # Plain sky until the layers are ready
+        arcade.set_background_color(arcade.color.SKY_BLUE)
 
     def on_draw(self):
         arcade.start_render()
-        self.grass.draw()
-        self.sand.draw()
-        self.snow.draw()
-        self.haunted.draw()
-        self.city.draw()
-        self.platforms.draw()
-        self.ladders.draw()
-        self.misc.draw()
+        if TitleView.layers_future.done():
+            TitleView.layers_future.result().draw(0, 0)
         arcade.draw_text("The Legend of Rakesh", SCREEN_WIDTH/2, SCREEN_HEIGHT/2 + 175, arcade.color.BLACK, font_size=100,
                          anchor_x="center")
         arcade.draw_text("Play", SCREEN_WIDTH/2, SCREEN_HEIGHT/2 + 80, arcade.color.BLACK, font_size=30,
@@ -259,9 +2078,7 @@ class TitleView(arcade.View):
 
     def on_mouse_press(self, x: float, y: float, button: int, modifiers: int):
         if 600 < x < 800 and 460 < y < 510:
-            game_view = GameWindow()
-            game_view.setup(game_view.level)
-            self.window.show_view(game_view)
+            self.window.show_view(take_game_view(LevelView.level))
 
         if 600 < x < 800 and 340 < y < 390:
             self.window.show_view(InstructionView())
@@ -328,30 +2145,91 @@ class LevelView(arcade.View):
 
         if 600 < x < 800 and 620 < y < 670:
             LevelView.level = 1
-            game_view = GameWindow()
-            game_view.setup(game_view.level)
-            self.window.show_view(game_view)
+            self.window.show_view(take_game_view(LevelView.level))
 
         if 600 < x < 800 and 380 < y < 430:
             LevelView.level = 2
-            game_view = GameWindow()
-            game_view.setup(game_view.level)
-            self.window.show_view(game_view)
+            self.window.show_view(take_game_view(LevelView.level))
 
         if 600 < x < 800 and 140 < y < 190:
             LevelView.level = 3
-            game_view = GameWindow()
-            game_view.setup(game_view.level)
-            self.window.show_view(game_view)
+            self.window.show_view(take_game_view(LevelView.level))
+
+class InputRecorder:
+    """
+    Writes a game view's input events and frame times to an input log, so the
+    session can be played back with replay_inputs().
+    """
+
+    def __init__(self, file_name: str, level: int):
+        self.file = open(file_name, "wb")
+        self.file.write(INPUT_LOG_HEADER.pack(INPUT_LOG_MAGIC, INPUT_LOG_VERSION, level))
+
+    def write(self, frame: int, kind: int, *data):
+        self.file.write(INPUT_LOG_RECORD.pack(frame, kind) + INPUT_LOG_DATA[kind].pack(*data))
+
+    def end_frame(self, frame: int, delta_time: float):
+        """ Record the length of a frame. Flushed every frame as the game can exit without warning. """
+        self.write(frame, RECORD_FRAME, delta_time)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_input_log(file_name: str):
+    """ Get the level an input log starts on and an iterator over its (frame, kind, data) records """
+    with open(file_name, "rb") as file:
+        log = file.read()
+    magic, version, level = INPUT_LOG_HEADER.unpack_from(log)
+    if magic != INPUT_LOG_MAGIC or version != INPUT_LOG_VERSION:
+        raise ValueError(f"{file_name} is not a version {INPUT_LOG_VERSION} input log")
+
+    def records():
+        offset = INPUT_LOG_HEADER.size
+        while offset < len(log):
+            frame, kind = INPUT_LOG_RECORD.unpack_from(log, offset)
+            offset += INPUT_LOG_RECORD.size
+            data = INPUT_LOG_DATA[kind].unpack_from(log, offset)
+            offset += INPUT_LOG_DATA[kind].size
+            yield frame, kind, data
+
+    return level, records()
+
+
+class HeadlessWindow:
+    """ Stands in for the arcade window when a game view runs without a display """
+    background_color = arcade.color.AMAZON
+
 
 class GameWindow(arcade.View):
     """ Main Window """
 
-    def __init__(self):
+    # Input log to record play to, see InputRecorder
+    record_path = None
+
+    def __init__(self, headless: bool = False):
         """ Create the variables """
 
         # Init the parent class
-        super().__init__()
+        super().__init__(HeadlessWindow() if headless else None)
+
+        # Without a display nothing is drawn or played, see run_headless()
+        self.headless = headless
+
+        # Set when the prize is reached in a headless run
+        self.finished = False
+
+        # Set when the exit is reached, the next level starts on the next frame
+        self.level_changed = False
+        self.has_next_level = False
+
+        # Set when setup() couldn't release the previous level's assets yet
+        self.release_pending = False
+
+        # Frames updated so far, and where they're being recorded to if anywhere
+        self.frame = 0
+        self.recorder: Optional[InputRecorder] = None
 
         # Player sprite
         self.player_sprite: Optional[PlayerSprite] = None
@@ -360,12 +2238,18 @@ class GameWindow(arcade.View):
         self.player_list: Optional[arcade.SpriteList] = None
         self.wall_list: Optional[arcade.SpriteList] = None
         self.bullet_list: Optional[arcade.SpriteList] = None
+        self.bullet_pool: Optional[BulletPool] = None
         self.item_list: Optional[arcade.SpriteList] = None
         self.moving_sprites_list: Optional[arcade.SpriteList] = None
         self.moving_spikes_list: Optional[arcade.SpriteList] = None
+        self.moving_sprites: Optional[MovingSprites] = None
+        self.activation_region: Optional[ActivationRegion] = None
         self.ladder_list: Optional[arcade.SpriteList] = None
-        self.grab_obj: Optional[arcade.SpriteList] = None
-        self.locked_obj: Optional[arcade.SpriteList] = None
+        self.key_lock_system: Optional[KeyLockSystem] = None
+        self.animations: Optional[AnimationScheduler] = None
+
+        # Pickups and hazards, which aren't sprites
+        self.entities: Optional[EntityStore] = None
 
         # Track the current state of what key is pressed
         self.left_pressed: bool = False
@@ -378,145 +2262,85 @@ class GameWindow(arcade.View):
         self.stars = 0
         self.level = LevelView.level
 
+        # Batched layer drawing and the HUD
+        self.backgrounds = []
+        self.render_pipeline: Optional[RenderPipeline] = None
+        self.hud_list: Optional[arcade.SpriteList] = None
+        self.score_text: Optional[HudText] = None
+        self.stars_text: Optional[HudText] = None
+
+        # Draw calls made by the last on_draw
+        self.draw_calls = 0
+
+        # Starting state of the level, recorded by snapshot()
+        self.initial_state = None
+        self.initial_player_pymunk = None
+
         # Physics engine
         self.physics_engine = Optional[arcade.PymunkPhysicsEngine]
 
-        # Set background color
+        # Time not yet simulated, and where the moving sprites were before the last step
+        self.physics_time = 0.0
+        self.previous_positions = []
+
+        # Bottom left of the view last given to arcade
+        self.viewport = (0, 0)
+
+        # Timings drawn over the game, toggled with F3
+        self.overlay = PerformanceOverlay()
+
+    def on_show(self):
+        """ Set background color when shown, as the view may be built on a loader thread """
         arcade.set_background_color(arcade.color.AMAZON)
+        if GameWindow.record_path and self.recorder is None:
+            self.recorder = InputRecorder(GameWindow.record_path, self.level)
 
+    @profiler.timed("setup")
     def setup(self, level):
         """ Set up everything with the game """
         self.view_bottom = 0
         self.view_left = 0
         self.score = 0
         self.stars = 0
-        self.key1_grabbed = False
-        self.key2_grabbed = False
-        self.key3_grabbed = False
-        self.key4_grabbed = False
+        self.previous_positions = []
 
         # Create the sprite lists
         self.player_list = arcade.SpriteList()
         self.bullet_list = arcade.SpriteList()
-        self.coin_list = arcade.SpriteList()
-        self.coin_sound = arcade.load_sound("/Users/mahirkhandokar/Desktop/Projects/the_legend_of_rakesh/venv/lib/python3.8/site-packages/arcade/resources/sounds/coin5.wav")
-        self.stars_list = arcade.SpriteList()
-        self.star_sound = arcade.load_sound("/Users/mahirkhandokar/Desktop/Projects/the_legend_of_rakesh/venv/lib/python3.8/site-packages/arcade/resources/sounds/upgrade1.wav")
-        self.spike_sound = arcade.load_sound("/Users/mahirkhandokar/Desktop/Projects/the_legend_of_rakesh/venv/lib/python3.8/site-packages/arcade/resources/sounds/hurt2.wav")
-        self.key_sound = arcade.load_sound("/Users/mahirkhandokar/Desktop/Projects/the_legend_of_rakesh/venv/lib/python3.8/site-packages/arcade/resources/sounds/secret4.wav")
-        self.bomb_sound = arcade.load_sound("/Users/mahirkhandokar/Desktop/Projects/the_legend_of_rakesh/venv/lib/python3.8/site-packages/arcade/resources/sounds/explosion2.wav")
-        self.unlock_sound = arcade.load_sound("/Users/mahirkhandokar/Desktop/Projects/the_legend_of_rakesh/venv/lib/python3.8/site-packages/arcade/resources/sounds/upgrade3.wav")
-        self.lava_sound = arcade.load_sound("/Users/mahirkhandokar/Desktop/Projects/the_legend_of_rakesh/venv/lib/python3.8/site-packages/arcade/resources/sounds/hit2.wav")
-        self.congrats = arcade.load_sound("/Users/mahirkhandokar/Desktop/Projects/the_legend_of_rakesh/venv/lib/python3.8/site-packages/arcade/resources/music/1918.mp3")
-
-        # Read in the tiled map
-        map_name = f"/Users/mahirkhandokar/Desktop/Projects/the_legend_of_rakesh/level_{level}.tmx"
-        my_map = arcade.tilemap.read_tmx(map_name)
-        self.background_list = arcade.tilemap.process_layer(my_map,
-                                                            'Background')
-        # Read in the map layers
-        self.wall_list = arcade.tilemap.process_layer(my_map,
-                                                      'Platforms',
-                                                      SPRITE_SCALING_TILES,
-                                                      hit_box_algorithm="Detailed")
-        self.lock1 = arcade.tilemap.process_layer(my_map,
-                                                  'Lock 1',
-                                                  SPRITE_SCALING_TILES,
-                                                  use_spatial_hash=True,
-                                                  hit_box_algorithm="None")
-        self.lock2 = arcade.tilemap.process_layer(my_map,
-                                                  'Lock 2',
-                                                  SPRITE_SCALING_TILES,
-                                                  use_spatial_hash=True,
-                                                  hit_box_algorithm="None")
-        self.lock3 = arcade.tilemap.process_layer(my_map,
-                                                  'Lock 3',
-                                                  SPRITE_SCALING_TILES,
-                                                  use_spatial_hash=True,
-                                                  hit_box_algorithm="None")
-        self.lock4 = arcade.tilemap.process_layer(my_map,
-                                                  'Lock 4',
-                                                  SPRITE_SCALING_TILES,
-                                                  use_spatial_hash=True,
-                                                  hit_box_algorithm="None")
-        self.p_wall_list = arcade.tilemap.process_layer(my_map,
-                                                        "Phasable walls",
-                                                        SPRITE_SCALING_TILES,
-                                                        hit_box_algorithm="Detailed")
-        self.misc = arcade.tilemap.process_layer(my_map,
-                                                 "Other Stuff",
-                                                 SPRITE_SCALING_TILES,
-                                                 hit_box_algorithm="Detailed")
-        self.item_list = arcade.tilemap.process_layer(my_map,
-                                                      'Dynamic Items',
-                                                      SPRITE_SCALING_TILES,
-                                                      hit_box_algorithm="Detailed")
-        self.ladder_list = arcade.tilemap.process_layer(my_map,
-                                                        'Ladders',
-                                                        SPRITE_SCALING_TILES,
-                                                        use_spatial_hash=True,
-                                                        hit_box_algorithm="Detailed")
-        self.coin_list = arcade.tilemap.process_layer(my_map,
-                                                      "Coins",
-                                                      SPRITE_SCALING_TILES,
-                                                      use_spatial_hash=True,
-                                                      hit_box_algorithm="Detailed")
-        self.key1 = arcade.tilemap.process_layer(my_map,
-                                                 "Key 1",
-                                                 SPRITE_SCALING_TILES,
-                                                 use_spatial_hash=True,
-                                                 hit_box_algorithm="Detailed")
-        self.key2 = arcade.tilemap.process_layer(my_map,
-                                                 "Key 2",
-                                                 SPRITE_SCALING_TILES,
-                                                 use_spatial_hash=True,
-                                                 hit_box_algorithm="Detailed")
-        self.key3 = arcade.tilemap.process_layer(my_map,
-                                                 "Key 3",
-                                                 SPRITE_SCALING_TILES,
-                                                 use_spatial_hash=True,
-                                                 hit_box_algorithm="Detailed")
-        self.key4 = arcade.tilemap.process_layer(my_map,
-                                                 "Key 4",
-                                                 SPRITE_SCALING_TILES,
-                                                 use_spatial_hash=True,
-                                                 hit_box_algorithm="Detailed")
-        self.spikes = arcade.tilemap.process_layer(my_map,
-                                                     "Spikes",
-                                                     SPRITE_SCALING_TILES,
-                                                     use_spatial_hash=True,
-                                                     hit_box_algorithm="Simple")
-        self.bombs = arcade.tilemap.process_layer(my_map,
-                                                  "Bombs",
-                                                  SPRITE_SCALING_TILES,
-                                                  use_spatial_hash=True,
-                                                  hit_box_algorithm="Detailed")
-        self.stars_list = arcade.tilemap.process_layer(my_map,
-                                                       "Stars",
-                                                       SPRITE_SCALING_TILES,
-                                                       use_spatial_hash=True,
-                                                       hit_box_algorithm="Detailed")
-        self.exit = arcade.tilemap.process_layer(my_map,
-                                                 "Exit Sign",
-                                                 SPRITE_SCALING_TILES,
-                                                 hit_box_algorithm="Detailed")
-        self.barrier = arcade.tilemap.process_layer(my_map,
-                                                    "Barrier",
-                                                    SPRITE_SCALING_TILES,
-                                                    use_spatial_hash=True,
-                                                    hit_box_algorithm="Detailed")
-        self.prize = arcade.tilemap.process_layer(my_map,
-                                                  "Prize",
-                                                  SPRITE_SCALING_TILES,
-                                                  hit_box_algorithm="Detailed")
-        self.lava = arcade.tilemap.process_layer(my_map,
-                                                 "Lava",
-                                                 SPRITE_SCALING_TILES,
-                                                 use_spatial_hash=True,
-                                                 hit_box_algorithm="Detailed")
+        self.coin_sound = self.load_sound(f"{ARCADE_RESOURCES}/sounds/coin5.wav")
+        self.star_sound = self.load_sound(f"{ARCADE_RESOURCES}/sounds/upgrade1.wav")
+        self.spike_sound = self.load_sound(f"{ARCADE_RESOURCES}/sounds/hurt2.wav")
+        self.key_sound = self.load_sound(f"{ARCADE_RESOURCES}/sounds/secret4.wav")
+        self.bomb_sound = self.load_sound(f"{ARCADE_RESOURCES}/sounds/explosion2.wav")
+        self.unlock_sound = self.load_sound(f"{ARCADE_RESOURCES}/sounds/upgrade3.wav")
+        self.lava_sound = self.load_sound(f"{ARCADE_RESOURCES}/sounds/hit2.wav")
+        self.congrats = self.load_sound(f"{ARCADE_RESOURCES}/music/1918.mp3")
+
+        # Build the map layers from the compiled level. The TMX file is only
+        # parsed again if it changed on disk since the last time it was read.
+        compiled_level = load_level(level)
+        self.has_next_level = os.path.exists(f"{PROJECT_PATH}/level_{level + 1}.tmx")
+        layer_lists = {layer_name: compiled_level.build_layer(layer_name)
+                       for layer_name in compiled_level.layers if layer_name not in ENTITY_LAYERS}
+        for attribute, layer_name, _options in LEVEL_LAYERS:
+            if attribute is not None:
+                setattr(self, attribute, layer_lists[layer_name])
+        self.key_lock_system = KeyLockSystem([(layer_lists[f"Key {number}"], layer_lists[f"Lock {number}"])
+                                              for number in compiled_level.key_lock_numbers])
+
+        # Every animated tile, whatever layer it's in, runs on one clock.
+        # Entity layers add theirs as their chunks get sprites.
+        self.animations = AnimationScheduler()
+        for layer_name, indexes in compiled_level.animated_tiles.items():
+            if layer_name in layer_lists:
+                for index in indexes:
+                    self.animations.add(layer_lists[layer_name][index])
+
+        # Coins, stars and hazards are entries in arrays rather than sprites
+        self.entities = EntityStore(compiled_level)
 
         # Create player sprite
-        self.player_sprite = PlayerSprite(self.ladder_list, hit_box_algorithm="Detailed")
+        self.player_sprite = PlayerSprite(hit_box_algorithm="Detailed")
 
         # Set player location
         grid_x = 1
@@ -525,17 +2349,7 @@ class GameWindow(arcade.View):
         self.player_sprite.center_y = SPRITE_SIZE * grid_y + SPRITE_SIZE / 2
         # Add to player sprite list
         self.player_list.append(self.player_sprite)
-
-        # Moving Platforms
-        self.moving_sprites_list = arcade.tilemap.process_layer(my_map,
-                                                                'Moving Platforms',
-                                                                SPRITE_SCALING_TILES)
-
-        # Moving Spikes
-        self.moving_spikes_list = arcade.tilemap.process_layer(my_map,
-                                                               "Moving Spikes",
-                                                               SPRITE_SCALING_TILES,
-                                                               hit_box_algorithm="Simple")
+        self.player_list.preload_textures(self.player_sprite.skin.textures)
 
         # --- Pymunk Physics Engine Setup ---
 
@@ -553,20 +2367,53 @@ class GameWindow(arcade.View):
         # Create the physics engine
         self.physics_engine = arcade.PymunkPhysicsEngine(damping=damping,
                                                          gravity=gravity)
-
-        def wall_hit_handler(bullet_sprite, _wall_sprite, _arbiter, _space, _data):
+        self.physics_engine.space.sleep_time_threshold = SLEEP_TIME_THRESHOLD
+
+        # Merged walls and ladders don't belong to a sprite, so their
+        # handlers are added to the pymunk space directly.
+        for collision_type in ("bullet", "wall", "player", "ladder", "hazard"):
+            if collision_type not in self.physics_engine.collision_types:
+                self.physics_engine.collision_types.append(collision_type)
+        bullet_type = self.physics_engine.collision_types.index("bullet")
+        wall_type = self.physics_engine.collision_types.index("wall")
+        player_type = self.physics_engine.collision_types.index("player")
+        ladder_type = self.physics_engine.collision_types.index("ladder")
+        hazard_type = self.physics_engine.collision_types.index("hazard")
+
+        def wall_hit_handler(arbiter, _space, _data):
             """ Called for bullet/wall collision """
-            bullet_sprite.remove_from_sprite_lists()
+            bullet_sprite = self.bullet_pool.shapes.get(arbiter.shapes[0])
+            if bullet_sprite is not None:
+                self.bullet_pool.release(bullet_sprite)
+
+        wall_handler = self.physics_engine.space.add_collision_handler(bullet_type, wall_type)
+        wall_handler.post_solve = wall_hit_handler
+
+        def ladder_begin_handler(_arbiter, _space, _data):
+            """ Called when the player starts touching a ladder """
+            self.player_sprite.ladder_contact(1)
+            return True
 
-        self.physics_engine.add_collision_handler("bullet", "wall", post_handler=wall_hit_handler)
+        def ladder_separate_handler(_arbiter, _space, _data):
+            """ Called when the player stops touching a ladder """
+            self.player_sprite.ladder_contact(-1)
+
+        ladder_handler = self.physics_engine.space.add_collision_handler(player_type, ladder_type)
+        ladder_handler.begin = ladder_begin_handler
+        ladder_handler.separate = ladder_separate_handler
 
         def item_hit_handler(bullet_sprite, item_sprite, _arbiter, _space, _data):
             """ Called for bullet/wall collision """
-            bullet_sprite.remove_from_sprite_lists()
+            self.bullet_pool.release(bullet_sprite)
             item_sprite.remove_from_sprite_lists()
 
         self.physics_engine.add_collision_handler("bullet", "item", post_handler=item_hit_handler)
 
+        # Bullets are made once per level and reused
+        self.bullet_pool = BulletPool(self.physics_engine, self.bullet_list, BULLET_POOL_SIZE,
+                                      compiled_level.map_width * compiled_level.tile_size,
+                                      compiled_level.map_height * compiled_level.tile_size)
+
         # Add the player.
         # For the player, we set the damping to a lower value, which increases
         # the damping rate. This prevents the character from traveling too far
@@ -592,41 +2439,50 @@ class GameWindow(arcade.View):
         # PymunkPhysicsEngine.KINEMATIC objects will move, but are assumed to be
         # repositioned by code and don't respond to physics forces.
         # Dynamic is default.
-        self.physics_engine.add_sprite_list(self.wall_list,
-                                            friction=WALL_FRICTION,
-                                            collision_type="wall",
-                                            body_type=arcade.PymunkPhysicsEngine.STATIC)
-
-        self.physics_engine.add_sprite_list(self.barrier,
-                                            friction=WALL_FRICTION,
-                                            collision_type="wall",
-                                            body_type=arcade.PymunkPhysicsEngine.STATIC)
-
-        self.physics_engine.add_sprite_list(self.spikes,
-                                            body_type=arcade.PymunkPhysicsEngine.STATIC)
-
-        self.physics_engine.add_sprite_list(self.bombs,
-                                            body_type=arcade.PymunkPhysicsEngine.STATIC)
-
-        self.physics_engine.add_sprite_list(self.lock1,
-                                            friction=WALL_FRICTION,
-                                            collision_type="wall",
-                                            body_type=arcade.PymunkPhysicsEngine.STATIC)
-
-        self.physics_engine.add_sprite_list(self.lock2,
-                                            friction=WALL_FRICTION,
-                                            collision_type="wall",
-                                            body_type=arcade.PymunkPhysicsEngine.STATIC)
-
-        self.physics_engine.add_sprite_list(self.lock3,
-                                            friction=WALL_FRICTION,
-                                            collision_type="wall",
-                                            body_type=arcade.PymunkPhysicsEngine.STATIC)
-
-        self.physics_engine.add_sprite_list(self.lock4,
-                                            friction=WALL_FRICTION,
-                                            collision_type="wall",
-                                            body_type=arcade.PymunkPhysicsEngine.STATIC)
+        # Solid platform and barrier tiles were merged into large rectangles
+        # when the level was compiled. Those go on the space's static body.
+        for left, bottom, right, top in compiled_level.wall_rectangles:
+            shape = pymunk.Poly.create_box_bb(self.physics_engine.space.static_body,
+                                              pymunk.BB(left, bottom, right, top))
+            shape.friction = WALL_FRICTION
+            shape.collision_type = wall_type
+            self.physics_engine.space.add(shape)
+
+        # Tiles that aren't rectangles, like slopes, keep their own shape
+        for wall_list, layer_name in ((self.wall_list, "Platforms"), (self.barrier, "Barrier")):
+            for index in compiled_level.unmerged_walls[layer_name]:
+                self.physics_engine.add_sprite(wall_list[index],
+                                               friction=WALL_FRICTION,
+                                               collision_type="wall",
+                                               body_type=arcade.PymunkPhysicsEngine.STATIC)
+
+        # Ladders are sensors: nothing bumps into them, the player just gets
+        # told when it starts and stops touching one
+        ladder_shapes = [pymunk.Poly.create_box_bb(self.physics_engine.space.static_body,
+                                                   pymunk.BB(left, bottom, right, top))
+                         for left, bottom, right, top in compiled_level.ladder_rectangles]
+        ladder_shapes.extend(pymunk.Poly(self.physics_engine.space.static_body,
+                                         self.ladder_list[index].get_adjusted_hit_box())
+                             for index in compiled_level.unmerged_ladders)
+        for shape in ladder_shapes:
+            shape.sensor = True
+            shape.collision_type = ladder_type
+            self.physics_engine.space.add(shape)
+
+        # Spikes and bombs are solid. They have no sprites, so their shapes
+        # go on the static body too.
+        for index in numpy.flatnonzero((self.entities.kind & (ENTITY_SPIKE | ENTITY_BOMB)) != 0):
+            shape = pymunk.Poly(self.physics_engine.space.static_body,
+                                EntityStore.place_hit_box(self.entities.tiles[index]))
+            shape.friction = HAZARD_FRICTION
+            shape.collision_type = hazard_type
+            self.physics_engine.space.add(shape)
+
+        for locks in self.key_lock_system.locks:
+            self.physics_engine.add_sprite_list(locks,
+                                                friction=WALL_FRICTION,
+                                                collision_type="wall",
+                                                body_type=arcade.PymunkPhysicsEngine.STATIC)
 
         # Create the items
         self.physics_engine.add_sprite_list(self.item_list,
@@ -639,9 +2495,178 @@ class GameWindow(arcade.View):
 
         self.physics_engine.add_sprite_list(self.moving_spikes_list,
                                             body_type=arcade.PymunkPhysicsEngine.KINEMATIC)
+        self.moving_sprites = MovingSprites(self.physics_engine,
+                                            (self.moving_sprites_list, self.moving_spikes_list))
+
+        # Only things near the screen are simulated
+        self.activation_region = ActivationRegion(self.physics_engine, self.item_list, self.moving_sprites)
+
+        # The background images are streamed in tiles around the screen
+        self.backgrounds = [StreamedBackground(image_path, left, bottom)
+                            for image_path, left, bottom in compiled_level.backgrounds]
+
+        # Static layers next to each other in the draw order are chunked and
+        # drawn together
+        self.render_pipeline = RenderPipeline([
+            *self.backgrounds,
+            [self.ladder_list],
+            self.moving_sprites_list,
+            self.bullet_list,
+            self.item_list,
+            [self.misc],
+            EntityLayer(self.entities, ENTITY_EXIT | ENTITY_PRIZE, CHUNK_SIZE, self.animations),
+            self.key_lock_system,
+            self.player_list,
+            EntityLayer(self.entities, ENTITY_COIN, CHUNK_SIZE, self.animations),
+            EntityLayer(self.entities, ENTITY_STAR, CHUNK_SIZE, self.animations),
+            EntityLayer(self.entities, ENTITY_BOMB, CHUNK_SIZE, self.animations),
+            [self.p_wall_list],
+            EntityLayer(self.entities, ENTITY_SPIKE, CHUNK_SIZE, self.animations),
+            self.moving_spikes_list,
+            EntityLayer(self.entities, ENTITY_LAVA, CHUNK_SIZE, self.animations),
+            [self.wall_list],
+        ], CHUNK_SIZE)
+
+        # Score and stars are drawn together, and only re-rendered on change
+        self.hud_list = arcade.SpriteList()
+        # Every score makes a new text texture. Like arcade.gui, let the list
+        # forget the old ones instead of keeping them all in its atlas.
+        self.hud_list._keep_textures = False
+        self.score_text = HudText(self.hud_list, arcade.color.BLACK, 14)
+        self.stars_text = HudText(self.hud_list, arcade.color.BLACK, 14)
+
+        # Remember how everything started, so dying can put it back
+        self.snapshot()
+
+        # Let go of anything only the previous level used, now or once the
+        # loader threads are idle
+        self.release_pending = not release_unused_assets()
+
+    def snapshot(self):
+        """
+        Record the starting state of everything that can move, be collected or
+        be unlocked. Static geometry is left out, it never changes.
+        """
+        self.initial_state = []
+        for sprite_list in (self.player_list, self.item_list,
+                            self.moving_sprites_list, self.moving_spikes_list,
+                            *self.key_lock_system.keys, *self.key_lock_system.locks):
+            for sprite in sprite_list:
+                self.initial_state.append((sprite,
+                                           sprite_list,
+                                           self.physics_engine.sprites.get(sprite),
+                                           sprite.position,
+                                           sprite.angle,
+                                           sprite.change_x,
+                                           sprite.change_y,
+                                           sprite.texture))
+
+        self.initial_player_pymunk = (self.player_sprite.pymunk.gravity,
+                                      self.player_sprite.pymunk.damping,
+                                      self.player_sprite.pymunk.max_vertical_velocity)
+
+    @profiler.timed("restore")
+    def restore(self):
+        """
+        Put the level back the way snapshot() found it. The physics space and
+        the static sprite lists are kept, so this costs the same on any map.
+        """
+        self.view_bottom = 0
+        self.view_left = 0
+        self.score = 0
+        self.stars = 0
+        self.previous_positions = []
+        self.key_lock_system.reset()
+        self.entities.reset()
+        self.animations.reset()
+
+        self.bullet_pool.release_all()
+
+        for (sprite, sprite_list, physics_object, position,
+             angle, change_x, change_y, texture) in self.initial_state:
+            # Put back anything that was picked up, unlocked or shot
+            if sprite_list not in sprite.sprite_lists:
+                sprite_list.append(sprite)
+            if physics_object is not None and sprite not in self.physics_engine.sprites:
+                self.physics_engine.space.add(physics_object.body, physics_object.shape)
+                self.physics_engine.sprites[sprite] = physics_object
+                if physics_object.body.body_type != arcade.PymunkPhysicsEngine.STATIC:
+                    self.physics_engine.non_static_sprite_list.append(sprite)
+                sprite.register_physics_engine(self.physics_engine)
+
+            if physics_object is not None and \
+                    physics_object.body.body_type != arcade.PymunkPhysicsEngine.STATIC:
+                body = physics_object.body
+                body.position = position
+                body.angle = math.radians(angle)
+                body.velocity = (0, 0)
+                body.angular_velocity = 0
+                body.force = (0, 0)
+
+            sprite.position = position
+            sprite.angle = angle
+            sprite.change_x = change_x
+            sprite.change_y = change_y
+            sprite.texture = texture
+
+        # Reset the player's ladder and animation state
+        (self.player_sprite.pymunk.gravity,
+         self.player_sprite.pymunk.damping,
+         self.player_sprite.pymunk.max_vertical_velocity) = self.initial_player_pymunk
+        self.player_sprite.is_on_ladder = False
+        # The ladder handler catches up on the next step, once pymunk sees
+        # the player has moved
+        self.player_sprite.set_on_ladder(self.player_sprite.ladder_contacts > 0)
+        self.player_sprite.character_face_direction = RIGHT_FACING
+        self.player_sprite.cur_texture = 0
+        self.player_sprite.x_odometer = 0
+        self.player_sprite.y_odometer = 0
+        self.physics_engine.set_friction(self.player_sprite, PLAYER_FRICTION)
+        self.moving_sprites.reset()
+        self.activation_region.reset()
+
+    def load_sound(self, file_name: str) -> Optional[str]:
+        """ Load a sound into the mixer, or nothing when headless """
+        if self.headless:
+            return None
+        return audio.load(file_name)
+
+    def play_sound(self, sound_id: Optional[str]):
+        """ Play a sound, unless headless """
+        if not self.headless:
+            audio.play(sound_id)
+
+    def input_bits(self) -> int:
+        """ The arrow keys held down, as INPUT_* bits """
+        return ((INPUT_LEFT if self.left_pressed else 0) |
+                (INPUT_RIGHT if self.right_pressed else 0) |
+                (INPUT_UP if self.up_pressed else 0) |
+                (INPUT_DOWN if self.down_pressed else 0))
+
+    def apply_input(self, bits: int):
+        """ Press and release arrow keys so the ones held down match the INPUT_* bits """
+        held = self.input_bits()
+        for bit, key in INPUT_KEYS:
+            if bits & bit and not held & bit:
+                self.on_key_press(key, 0)
+            elif held & bit and not bits & bit:
+                self.on_key_release(key, 0)
+
+    def state(self) -> tuple:
+        """ Where the player is and what they've collected, for comparing runs """
+        body = self.physics_engine.get_physics_object(self.player_sprite).body
+        return (self.level, self.score, self.stars,
+                tuple(body.position), tuple(body.velocity), self.player_sprite.is_on_ladder)
 
     def on_key_press(self, key, modifiers):
         """Called whenever a key is pressed. """
+        if self.recorder:
+            self.recorder.write(self.frame, RECORD_KEY_PRESS, key, modifiers)
+
+        if key == arcade.key.F3:
+            self.overlay.visible = not self.overlay.visible
+        elif key == arcade.key.F4:
+            profiler.dump_chrome_trace(time.strftime("trace-%Y%m%d-%H%M%S.json"))
 
         if key == arcade.key.LEFT:
             self.left_pressed = True
@@ -650,7 +2675,7 @@ class GameWindow(arcade.View):
         elif key == arcade.key.UP:
             self.up_pressed = True
             # find out if player is standing on ground, and not on a ladder
-            if self.physics_engine.is_on_ground(self.player_sprite) \
+            if is_grounded(self.physics_engine, self.player_sprite) \
                     and not self.player_sprite.is_on_ladder:
                 # She is! Go ahead and jump
                 impulse = (0, PLAYER_JUMP_IMPULSE)
@@ -660,6 +2685,8 @@ class GameWindow(arcade.View):
 
     def on_key_release(self, key, modifiers):
         """Called when the user releases a key. """
+        if self.recorder:
+            self.recorder.write(self.frame, RECORD_KEY_RELEASE, key, modifiers)
 
         if key == arcade.key.LEFT:
             self.left_pressed = False
@@ -672,14 +2699,12 @@ class GameWindow(arcade.View):
 
     def on_mouse_press(self, x, y, button, modifiers):
         """ Called whenever the mouse button is clicked. """
-
-        bullet = BulletSprite(20, 5, arcade.color.DARK_YELLOW)
-        self.bullet_list.append(bullet)
+        if self.recorder:
+            self.recorder.write(self.frame, RECORD_MOUSE_PRESS, int(x), int(y), button, modifiers)
 
         # Position the bullet at the player's current location
         start_x = self.player_sprite.center_x
         start_y = self.player_sprite.center_y
-        bullet.position = self.player_sprite.position
 
         # Get from the mouse the destination location for the bullet
         # IMPORTANT! If you have a scrolling screen, you will also need
@@ -699,33 +2724,106 @@ class GameWindow(arcade.View):
         size = max(self.player_sprite.width, self.player_sprite.height) / 2
 
         # Use angle to to spawn bullet away from player in proper direction
-        bullet.center_x += size * math.cos(angle)
-        bullet.center_y += size * math.sin(angle)
-
-        # Set angle of bullet
-        bullet.angle = math.degrees(angle)
-
-        # Gravity to use for the bullet
-        # If we don't use custom gravity, bullet drops too fast, or we have
-        # to make it go too fast.
-        # Force is in relation to bullet's angle.
-        bullet_gravity = (0, -BULLET_GRAVITY)
-
-        # Add the sprite. This needs to be done AFTER setting the fields above.
-        self.physics_engine.add_sprite(bullet,
-                                       mass=BULLET_MASS,
-                                       damping=1.0,
-                                       friction=0.6,
-                                       collision_type="bullet",
-                                       gravity=bullet_gravity,
-                                       elasticity=0.9)
-        # Add force to bullet
-        force = (BULLET_MOVE_FORCE, 0)
-        self.physics_engine.apply_force(bullet, force)
+        position = (start_x + size * math.cos(angle), start_y + size * math.sin(angle))
+        self.bullet_pool.fire(position, math.degrees(angle))
 
+    @profiler.timed("update")
     def on_update(self, delta_time):
+        """ Run as many fixed steps as the frame took, then place sprites between the last two """
+        if self.recorder:
+            self.recorder.end_frame(self.frame, delta_time)
+        self.frame += 1
+        self.physics_time += delta_time
+
+        # Sprites were left part way between steps for drawing, put them back where the physics has them
+        for sprite, body, previous_position in self.previous_positions:
+            sprite.position = body.position
+
+        steps = 0
+        while self.physics_time >= PHYSICS_STEP:
+            if steps == MAX_PHYSICS_STEPS:
+                self.physics_time = 0
+                break
+            self.previous_positions = [(sprite, self.physics_engine.sprites[sprite].body, sprite.position)
+                                       for sprite in self.blended_sprites()]
+            self.fixed_update(PHYSICS_STEP)
+            self.physics_time -= PHYSICS_STEP
+            steps += 1
+            if self.finished:
+                return
+            if self.level_changed:
+                # What's left of the frame's time is spent on the new level next frame
+                self.level_changed = False
+                return
+
+        # How far we are into the next step
+        blend = self.physics_time / PHYSICS_STEP
+        for sprite, body, (previous_x, previous_y) in self.previous_positions:
+            x, y = body.position
+            sprite.position = (previous_x + (x - previous_x) * blend,
+                               previous_y + (y - previous_y) * blend)
+
+        self.scroll_viewport()
+        self.activation_region.update(self.view_left, self.view_bottom, delta_time)
+
+        if not self.headless:
+            self.key_lock_system.follow(self.player_sprite)
+            with profiler.scope("animations"):
+                self.animations.update(delta_time)
+
+        if not self.headless:
+            # Get the next level ready while this one is finished off
+            if self.has_next_level and self.near_level_end():
+                prebuild_game_view(self.level + 1)
+
+            with profiler.scope("release"):
+                retired_views.update()
+                if self.release_pending:
+                    self.release_pending = not release_unused_assets()
+
+    def near_level_end(self) -> bool:
+        """ Whether the player has every star or is close to an exit """
+        if self.entities.remaining[ENTITY_STAR] == 0:
+            return True
+        return self.entities.near(ENTITY_EXIT, self.player_sprite.center_x, self.player_sprite.center_y,
+                                  PREFETCH_DISTANCE)
+
+    def next_level(self):
+        """
+        Move on to the next level, from the next frame. On screen that's a
+        switch to the game view built in the background, and this one is
+        taken apart over the following frames.
+        """
+        if self.headless:
+            self.level += 1
+            self.setup(self.level)
+            self.level_changed = True
+            return
+
+        next_view = take_game_view(self.level + 1)
+        # Carry on where this view left off, as if it had been set up again
+        next_view.frame = self.frame
+        next_view.physics_time = self.physics_time - PHYSICS_STEP
+        next_view.left_pressed = self.left_pressed
+        next_view.right_pressed = self.right_pressed
+        next_view.up_pressed = self.up_pressed
+        next_view.down_pressed = self.down_pressed
+        next_view.recorder, self.recorder = self.recorder, None
+        next_view.overlay.visible = self.overlay.visible
+        self.window.show_view(next_view)
+
+        self.level_changed = True
+        retired_views.add(release_game_view(self))
+
+    def blended_sprites(self):
+        """ The sprites drawn part way between physics steps. Headless, only the player, for the view. """
+        if self.headless:
+            return (self.player_sprite,)
+        return self.physics_engine.non_static_sprite_list
+
+    def fixed_update(self, delta_time):
         """ Movement and game logic """
-        is_on_ground = self.physics_engine.is_on_ground(self.player_sprite)
+        is_on_ground = is_grounded(self.physics_engine, self.player_sprite)
         # Update player forces based on keys pressed
         if self.left_pressed and not self.right_pressed:
             # Create a force to the left. Apply it.
@@ -764,246 +2862,227 @@ class GameWindow(arcade.View):
             # Player's feet are not moving. Therefore up the friction so we stop.
             self.physics_engine.set_friction(self.player_sprite, 1.0)
 
-        # Move items in the physics engine
-        self.physics_engine.step()
-
-        # For each moving sprite, see if we've reached a boundary and need to
-        # reverse course.
-        for moving_sprite in self.moving_sprites_list:
-            if moving_sprite.boundary_right and \
-                    moving_sprite.change_x > 0 and \
-                    moving_sprite.right > moving_sprite.boundary_right:
-                moving_sprite.change_x *= -1
-            elif moving_sprite.boundary_left and \
-                    moving_sprite.change_x < 0 and \
-                    moving_sprite.left > moving_sprite.boundary_left:
-                moving_sprite.change_x *= -1
-            if moving_sprite.boundary_top and \
-                    moving_sprite.change_y > 0 and \
-                    moving_sprite.top > moving_sprite.boundary_top:
-                moving_sprite.change_y *= -1
-            elif moving_sprite.boundary_bottom and \
-                    moving_sprite.change_y < 0 and \
-                    moving_sprite.bottom < moving_sprite.boundary_bottom:
-                moving_sprite.change_y *= -1
-
-            # Figure out and set our moving platform velocity.
-            # Pymunk uses velocity is in pixels per second. If we instead have
-            # pixels per frame, we need to convert.
-            velocity = (moving_sprite.change_x * 1 / delta_time, moving_sprite.change_y * 1 / delta_time)
-            self.physics_engine.set_velocity(moving_sprite, velocity)
-
-        for moving_sprite in self.moving_spikes_list:
-            if moving_sprite.boundary_right and \
-                    moving_sprite.change_x > 0 and \
-                    moving_sprite.right > moving_sprite.boundary_right:
-                moving_sprite.change_x *= -1
-            elif moving_sprite.boundary_left and \
-                    moving_sprite.change_x < 0 and \
-                    moving_sprite.left > moving_sprite.boundary_left:
-                moving_sprite.change_x *= -1
-            if moving_sprite.boundary_top and \
-                    moving_sprite.change_y > 0 and \
-                    moving_sprite.top > moving_sprite.boundary_top:
-                moving_sprite.change_y *= -1
-            elif moving_sprite.boundary_bottom and \
-                    moving_sprite.change_y < 0 and \
-                    moving_sprite.bottom < moving_sprite.boundary_bottom:
-                moving_sprite.change_y *= -1
-
-            velocity = (moving_sprite.change_x * 1 / delta_time, moving_sprite.change_y * 1 / delta_time)
-            self.physics_engine.set_velocity(moving_sprite, velocity)
-
-        self.coin_list.update_animation(delta_time)
-        coin_hit_list = arcade.check_for_collision_with_list(self.player_sprite, self.coin_list)
-
+        # Move items in the physics engine. Headless, nothing is drawn, so
+        # only the sprites the game logic looks at are moved to their bodies:
+        # the player here, and moving spikes when they're near it.
+        with profiler.scope("physics step"):
+            self.physics_engine.step(delta_time, resync_sprites=not self.headless)
+            if self.headless:
+                self.player_sprite.position = self.physics_engine.sprites[self.player_sprite].body.position
+
+        self.move_moving_sprites(delta_time)
+        self.bullet_pool.update(delta_time)
+        self.check_collisions(delta_time)
+
+    @profiler.timed("moving sprites")
+    def move_moving_sprites(self, delta_time):
+        """ Turn moving platforms and spikes around at their boundaries """
+        self.moving_sprites.update(delta_time)
+
+    @profiler.timed("collisions")
+    def check_collisions(self, delta_time):
+        """ Pick things up, die, or finish the level, depending on what the player touches """
+        # Every pickup and hazard the player is touching, in one query
+        hits = self.entities.collisions(self.player_sprite, ENTITY_ANY)
+        kinds = self.entities.kind[hits]
+        touching = int(numpy.bitwise_or.reduce(kinds)) if len(hits) else 0
+
+        coin_hit_list = hits[kinds == ENTITY_COIN]
         for coin in coin_hit_list:
             self.score += len(coin_hit_list)
-            arcade.play_sound(self.coin_sound)
-            coin.remove_from_sprite_lists()
-
-        self.stars_list.update_animation(delta_time)
-        star_hit_list = arcade.check_for_collision_with_list(self.player_sprite, self.stars_list)
+            self.play_sound(self.coin_sound)
+            self.entities.kill(coin)
 
+        star_hit_list = hits[kinds == ENTITY_STAR]
         for star in star_hit_list:
             self.stars += len(star_hit_list)
-            arcade.play_sound(self.star_sound)
-            star.remove_from_sprite_lists()
-
-        self.key1.update_animation(delta_time)
-        key_hit_list = arcade.check_for_collision_with_list(self.player_sprite, self.key1)
-
-        if not self.key1_grabbed:
-            if key_hit_list:
-                arcade.play_sound(self.key_sound)
-        if len(key_hit_list) > 0:
-            self.key1_grabbed = True
-        if len(key_hit_list) == 0:
-            self.key1_grabbed = False
-
-        for key in key_hit_list:
-            key.position = self.player_sprite.position
-
-        self.lock1.update_animation(delta_time)
-
-        if len(self.lock1) == 1 and len(self.key1) == 1:
-            if arcade.check_for_collision(self.key1[0], self.lock1[0]):
-                self.lock1[0].remove_from_sprite_lists()
-                self.key1[0].remove_from_sprite_lists()
-
-        self.key2.update_animation(delta_time)
-        key_hit_list = arcade.check_for_collision_with_list(self.player_sprite, self.key2)
-
-        if not self.key2_grabbed:
-            if key_hit_list:
-                arcade.play_sound(self.key_sound)
-        if len(key_hit_list) > 0:
-            self.key2_grabbed = True
-        if len(key_hit_list) == 0:
-            self.key2_grabbed = False
-
-        for key in key_hit_list:
-            key.position = self.player_sprite.position
-
-        self.lock2.update_animation(delta_time)
-
-        if len(self.lock2) == 1 and len(self.key2) == 1:
-            if arcade.check_for_collision(self.key2[0], self.lock2[0]):
-                self.lock2[0].remove_from_sprite_lists()
-                self.key2[0].remove_from_sprite_lists()
-
-        self.key3.update_animation(delta_time)
-        key_hit_list = arcade.check_for_collision_with_list(self.player_sprite, self.key3)
-
-        if not self.key3_grabbed:
-            if key_hit_list:
-                arcade.play_sound(self.key_sound)
-        if len(key_hit_list) > 0:
-            self.key3_grabbed = True
-        if len(key_hit_list) == 0:
-            self.key3_grabbed = False
-
-        for key in key_hit_list:
-            key.position = self.player_sprite.position
-
-        self.lock3.update_animation(delta_time)
-
-        if len(self.lock3) == 1 and len(self.lock3) == 1:
-            if arcade.check_for_collision(self.key3[0], self.lock3[0]):
-                self.lock3[0].remove_from_sprite_lists()
-                self.key3[0].remove_from_sprite_lists()
-
-        self.key4.update_animation(delta_time)
-        key_hit_list = arcade.check_for_collision_with_list(self.player_sprite, self.key4)
-
-        if not self.key4_grabbed:
-            if key_hit_list:
-                arcade.play_sound(self.key_sound)
-        if len(key_hit_list) > 0:
-            self.key4_grabbed = True
-        if len(key_hit_list) == 0:
-            self.key4_grabbed = False
-
-        for key in key_hit_list:
-            key.position = self.player_sprite.position
-
-        self.lock4.update_animation(delta_time)
-
-        if len(self.lock4) == 1 and len(self.key4) == 1:
-            if arcade.check_for_collision(self.key4[0], self.lock4[0]):
-                self.lock4[0].remove_from_sprite_lists()
-                self.key4[0].remove_from_sprite_lists()
-
-        if arcade.check_for_collision_with_list(self.player_sprite, self.spikes):
-            arcade.play_sound(self.spike_sound)
-            self.setup(self.level)
-
-        if arcade.check_for_collision_with_list(self.player_sprite, self.bombs):
-            arcade.play_sound(self.bomb_sound)
-            self.setup(self.level)
+            self.play_sound(self.star_sound)
+            self.entities.kill(star)
+
+        # Pick up keys and use them on their locks
+        with profiler.scope("key/lock"):
+            picked_up = self.key_lock_system.update(self.player_sprite)
+        for _ in range(picked_up):
+            self.play_sound(self.key_sound)
+
+        # Dying puts the player back at the start, away from anything touched
+        if touching & ENTITY_SPIKE:
+            self.play_sound(self.spike_sound)
+            self.restore()
+            return
 
-        if arcade.check_for_collision_with_list(self.player_sprite, self.moving_spikes_list):
-            arcade.play_sound(self.spike_sound)
-            self.setup(self.level)
+        if touching & ENTITY_BOMB:
+            self.play_sound(self.bomb_sound)
+            self.restore()
+            return
 
-        if arcade.check_for_collision_with_list(self.player_sprite, self.lava):
-            arcade.play_sound(self.lava_sound)
-            self.setup(self.level)
+        # Only the moving spikes around the player are tested properly, and
+        # headless, only those are moved to their bodies for it
+        spikes = self.moving_sprites.near(*hit_box_bounds(self.player_sprite.get_adjusted_hit_box()),
+                                          start=len(self.moving_sprites_list))
+        if self.headless:
+            self.moving_sprites.place_sprites(spikes)
+        if any(arcade.check_for_collision(self.player_sprite, self.moving_sprites.sprites[spike])
+               for spike in spikes):
+            self.play_sound(self.spike_sound)
+            self.restore()
+            return
 
-        changed_viewport = False
+        if touching & ENTITY_LAVA:
+            self.play_sound(self.lava_sound)
+            self.restore()
+            return
 
-        if len(self.stars_list) == 0:
-            if arcade.check_for_collision_with_list(self.player_sprite, self.prize):
+        if self.entities.remaining[ENTITY_STAR] == 0:
+            if touching & ENTITY_PRIZE:
+                if self.headless:
+                    self.finished = True
+                    return
+                if self.recorder:
+                    self.recorder.close()
                 os._exit(1)
 
-        if len(self.stars_list) == 0:
-            if arcade.check_for_collision_with_list(self.player_sprite, self.exit):
-                self.level += 1
-                self.setup(self.level)
-                self.view_left = 0
-                self.view_bottom = 0
-                changed_viewport = True
+            if touching & ENTITY_EXIT:
+                self.next_level()
 
+    def scroll_viewport(self):
+        """ Keep the player inside the margins of the screen """
         left_boundary = self.view_left + LEFT_VIEWPORT_MARGIN
         if self.player_sprite.left < left_boundary:
             self.view_left -= left_boundary - self.player_sprite.left
-            changed_viewport = True
         right_boundary = self.view_left + SCREEN_WIDTH - RIGHT_VIEWPORT_MARGIN
         if self.player_sprite.right > right_boundary:
             self.view_left += self.player_sprite.right - right_boundary
-            changed_viewport = True
         top_boundary = self.view_bottom + SCREEN_HEIGHT - TOP_VIEWPORT_MARGIN
         if self.player_sprite.top > top_boundary:
             self.view_bottom += self.player_sprite.top - top_boundary
-            changed_viewport = True
         bottom_boundary = self.view_bottom + BOTTOM_VIEWPORT_MARGIN
         if self.player_sprite.bottom < bottom_boundary:
             self.view_bottom -= bottom_boundary - self.player_sprite.bottom
-            changed_viewport = True
-        if changed_viewport:
-            self.view_bottom = int(self.view_bottom)
-            self.view_left = int(self.view_left)
-            arcade.set_viewport(self.view_left,
-                                SCREEN_WIDTH + self.view_left,
-                                self.view_bottom,
-                                SCREEN_HEIGHT + self.view_bottom)
+        self.view_bottom = int(self.view_bottom)
+        self.view_left = int(self.view_left)
+
+        # Setting up a level or dying also moves the view, so compare with what's on screen
+        if self.viewport != (self.view_left, self.view_bottom):
+            self.viewport = (self.view_left, self.view_bottom)
+            if not self.headless:
+                arcade.set_viewport(self.view_left,
+                                    SCREEN_WIDTH + self.view_left,
+                                    self.view_bottom,
+                                    SCREEN_HEIGHT + self.view_bottom)
 
     def on_draw(self):
         """ Draw everything """
-        arcade.start_render()
-        self.background_list.draw()
-        self.ladder_list.draw()
-        self.moving_sprites_list.draw()
-        self.bullet_list.draw()
-        self.item_list.draw()
-        self.misc.draw()
-        self.exit.draw()
-        self.prize.draw()
-        self.lock1.draw()
-        self.key1.draw()
-        self.lock2.draw()
-        self.key2.draw()
-        self.lock3.draw()
-        self.key3.draw()
-        self.lock4.draw()
-        self.key4.draw()
-        self.player_list.draw()
-        self.coin_list.draw()
-        self.stars_list.draw()
-        self.bombs.draw()
-        self.p_wall_list.draw()
-        self.spikes.draw()
-        self.moving_spikes_list.draw()
-        self.lava.draw()
-        self.wall_list.draw()
-
-        score = f"Score: {self.score}"
-        arcade.draw_text(score, 10 + self.view_left, 10 + self.view_bottom, arcade.color.BLACK, 14)
-        stars = f"Stars: {self.stars}"
-        arcade.draw_text(stars, 110 + self.view_left, 10 + self.view_bottom, arcade.color.BLACK, 14)
+        profiler.mark_frame()
+        with profiler.scope("draw"):
+            arcade.start_render()
+            with profiler.scope("draw layers"):
+                self.draw_calls = self.render_pipeline.draw(self.view_left, self.view_bottom)
+
+            with profiler.scope("hud"):
+                self.score_text.update(f"Score: {self.score}", 10 + self.view_left, 10 + self.view_bottom)
+                self.stars_text.update(f"Stars: {self.stars}", 110 + self.view_left, 10 + self.view_bottom)
+                self.hud_list.draw()
+                self.draw_calls += 1
+
+        # Drawn outside the timed scope, so it doesn't count itself
+        if self.overlay.visible:
+            self.overlay.draw(self)
+
+
+def run_headless(level: int, inputs, delta_time: float = HEADLESS_DELTA_TIME) -> GameWindow:
+    """
+    Play a level without a display, one frame of INPUT_* bits at a time.
+
+    Every frame is the same length, so the same inputs always give the same result.
+    """
+    game_view = GameWindow(headless=True)
+    game_view.level = level
+    game_view.setup(level)
+    for bits in inputs:
+        game_view.apply_input(bits)
+        game_view.on_update(delta_time)
+        if game_view.finished:
+            break
+    return game_view
+
+
+def replay_inputs(file_name: str) -> tuple:
+    """
+    Play an input log back headless, frame by frame.
+    Returns the game view and how long each frame's on_update took, in seconds.
+    """
+    level, records = read_input_log(file_name)
+    game_view = GameWindow(headless=True)
+    game_view.level = level
+    game_view.setup(level)
+    frame_times = []
+    for frame, kind, data in records:
+        if kind == RECORD_FRAME:
+            start_time = time.perf_counter()
+            game_view.on_update(*data)
+            frame_times.append(time.perf_counter() - start_time)
+            if game_view.finished:
+                break
+        elif kind == RECORD_KEY_PRESS:
+            game_view.on_key_press(*data)
+        elif kind == RECORD_KEY_RELEASE:
+            game_view.on_key_release(*data)
+        elif kind == RECORD_MOUSE_PRESS:
+            game_view.on_mouse_press(*data)
+    return game_view, frame_times
+
 
 def main():
     """ Main method """
+    parser = argparse.ArgumentParser(description=SCREEN_TITLE)
+    parser.add_argument("--headless", action="store_true",
+                        help="run the game logic without a display or sound and print the end state")
+    parser.add_argument("--level", type=int, default=1, help="level to run headless")
+    parser.add_argument("--frames", type=int, default=3600, help="frames to run headless")
+    parser.add_argument("--inputs", help="file of INPUT_* bits to run headless, one byte per frame")
+    parser.add_argument("--record", help="input log to record play to")
+    parser.add_argument("--replay", help="input log to play back headless")
+    parser.add_argument("--timings", help="file to write each replayed frame's update time to, in ms")
+    parser.add_argument("--trace", help="Chrome trace file to write the end of a headless run or replay to")
+    args = parser.parse_args()
+
+    if args.replay:
+        game_view, frame_times = replay_inputs(args.replay)
+        print(game_view.state())
+        if args.trace:
+            profiler.dump_chrome_trace(args.trace)
+        if args.timings:
+            with open(args.timings, "w") as file:
+                file.writelines(f"{frame_time * 1000:.4f}\n" for frame_time in frame_times)
+        if not frame_times:
+            return
+        frame_times.sort()
+        print(f"{len(frame_times)} frames, median {frame_times[len(frame_times) // 2] * 1000:.3f} ms, "
+              f"slowest {frame_times[-1] * 1000:.3f} ms")
+        return
+
+    if args.headless:
+        if args.inputs:
+            with open(args.inputs, "rb") as file:
+                inputs = file.read()
+        else:
+            inputs = bytes([INPUT_RIGHT]) * args.frames
+        # Compile the level first so the run time is mostly frames
+        start_time = time.perf_counter()
+        load_level(args.level)
+        load_time = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        game_view = run_headless(args.level, inputs)
+        run_time = time.perf_counter() - start_time
+        print(game_view.state())
+        if args.trace:
+            profiler.dump_chrome_trace(args.trace)
+        print(f"Level compiled in {load_time:.2f} s, {len(inputs)} frames run in {run_time:.2f} s "
+              f"({len(inputs) / run_time:.0f} per second)")
+        return
+
+    GameWindow.record_path = args.record
     window = arcade.Window(SCREEN_WIDTH, SCREEN_HEIGHT, SCREEN_TITLE, False, True)
     window.show_view(TitleView())
     arcade.run()
@@ -0,0 +1,37 @@
+"""
+Trace the hit box of every tile the levels and the title screen use, so the
+game starts with a full hit box cache:
+
+    python prewarm_hit_boxes.py
+"""
+import glob
+import re
+import time
+
+import pyglet
+
+# Nothing is drawn, so there's no need for a window
+pyglet.options["shadow_window"] = False
+
+import main
+
+
+def prewarm():
+    """ Compile every level and read the title screen's map, then save the cache """
+    start_time = time.perf_counter()
+    levels = sorted(int(re.search(r"level_(\d+)\.tmx$", map_name).group(1))
+                    for map_name in glob.glob(f"{main.PROJECT_PATH}/level_*.tmx"))
+    for level in levels:
+        print(f"Level {level}")
+        main.load_level(level)
+    print("Title screen")
+    main.load_title_layers()
+
+    main.hit_boxes.save()
+    stats = main.hit_boxes.stats()
+    print(f"{stats['cached']} hit boxes in {main.hit_boxes.file_name}: {stats['misses']} traced, "
+          f"{stats['hits']} already cached, in {time.perf_counter() - start_time:.1f} s")
+
+
+if __name__ == "__main__":
+    prewarm()